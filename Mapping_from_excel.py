@@ -1,19 +1,34 @@
 import pandas as pd
-import requests
-import csv
-from spellchecker import SpellChecker
 import re
-import wordsegment
-import spacy
-import subprocess
-import datetime
-
-wordsegment.load()
-name_concept_mapping = dict()
+import segmenter
+import logging
+import os
+import time
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import llm_batch
+import llm_cache
+import rf2_index
+import vector_index
+import spelling
+import fuzzy_rank
+import metrics
+import deadline
+import negative_cache
+from mapping_store import MappingStore
+from llm_client import CLOSEST_FSN_PROMPT, EXPAND_PROMPT
+from snowstorm import get_concept_record, load_concept_records, release_version, search_concepts
+
+logger = logging.getLogger(__name__)
+name_concept_mapping = MappingStore()
+
+# Number of diagnosis names mapped at the same time
+MAPPING_WORKERS = int(os.environ.get("MAPPING_WORKERS", "8"))
 
 def segment_compound_word(compound_word):
     # Segment the compound word into individual words
-    segmented_words = wordsegment.segment(compound_word)
+    segmented_words = segmenter.segment(compound_word)
     
     # Check if segmentation is possible
     if len(segmented_words) > 1:
@@ -27,145 +42,115 @@ def segment_compound_word(compound_word):
 
 #Corrects spelling of the words
 def correct_text(text):
-    spell = SpellChecker()
-    words = text.split()
-    corrected_text = []
-    for word in words:
-        # Correct the spelling of each word
-        corrected_word = spell.correction(word)
-        corrected_text.append(corrected_word)
-    if None in corrected_text:
-        return None
-    return ' '.join(corrected_text)
+    # The corrector is built once from the clinical vocabulary and caches each word
+    return spelling.correct(text)
 
 # This function checks if the concept is active or not
 def is_concept_active(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            # Check if the 'active' field is True
-            if data.get('active', False):
-                return True
-            else:
-                return False
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return []
+    record = get_concept_record(code)
+    if record is None:
+        return []
+    return record.active
 
 #This function gets all the active synonyms for a particular concept
 def get_display_name_from_snowstorm(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            # Initialize an empty list to store the terms
-            descriptions = []
-            # Iterate over each dictionary in the 'descriptions' list
-            for desc in data.get('descriptions', []):
-                # Check if the 'active' field is True
-                if desc.get('active', False):
-                    # Get the value of the 'term' key, defaulting to an empty string if not present
-                    term = desc.get('term', '')
-                    # Append the term to the 'descriptions' list
-                    descriptions.append(term)
-            return descriptions
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return []
+    record = get_concept_record(code)
+    if record is None:
+        return []
+    return list(record.synonyms)
 
 #this function checks whether the concept is a finding or disorder type
 def check_fsn_type(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            concept = data["fsn"]["term"]
-            if "(disorder)" in concept or "(finding)" in concept:
-                return True
-            return False
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return []
+    record = get_concept_record(code)
+    if record is None:
+        return []
+    return record.semantic_tag in ("disorder", "finding")
 
 # Function to call medllama2 using ollama
-def run_ollama_medllama2(query):
-    try:
-        command = ['ollama', 'run', 'llama3', '--', query]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, encoding='utf-8')
-        if result.returncode != 0:
-            print("Error running the command:", result.stderr)
-            return None
-        return result.stdout.strip()
-    except Exception as e:
-        print("An error occurred:", e)
-        return None
+def run_ollama_medllama2(template, **inputs):
+    return llm_cache.cached_generate(template, **inputs)
 
 #This function gets me the code we search for the term on snowstorm
 def get_concept_id(name):
-    url = f"http://localhost:8080/MAIN/concepts?term={name}"
+    matched_concepts = []
+    synonym_concept_mapping = {}
+    all_candidates = []
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            matched_concepts = []
-            synonym_concept_mapping = {}
-
-            if data['total'] != 0:
-                # First pass: Check FSNs and collect potential matches
-                for item in data['items']:
-                    if 'fsn' in item and 'term' in item['fsn']:
-                        fsn_term = re.sub(r'\(.*?\)', '', item['fsn']['term'].lower())
-                        if check_fsn_type(item['conceptId']) and item['active']:
-                            matched_concepts.append((fsn_term, item['conceptId']))
-                            if name.lower() == fsn_term:
-                                return item['conceptId']
-    
-                # Second pass: Check synonyms if FSN did not match exactly
-                for item in data['items']:
-                    if check_fsn_type(item['conceptId']) and item['active']:
-                        synonyms = get_display_name_from_snowstorm(item['conceptId'])
-                        for synonym in synonyms:
-                            synonym_term = synonym.lower()
-                            synonym_concept_mapping[synonym_term] = item['conceptId']
-                            if name.lower() == synonym_term:
-                                return item['conceptId']
-    
-                # Third pass: Check if the name is a subset of any synonyms
-                for synonym_term, concept_id in synonym_concept_mapping.items():
-                    if name.lower() in synonym_term:
-                        return concept_id
+        # Snowstorm filters to active findings/disorders and pages through the results
+        for items in search_concepts(name):
+            # Hydrate the page in one bulk request and keep the findings/disorders
+            records = load_concept_records([item['conceptId'] for item in items])
+            candidates = []
+            for item in items:
+                record = records.get(item['conceptId'])
+                if item['active'] and record is not None and record.fsn and record.semantic_tag in ("disorder", "finding"):
+                    candidates.append(record)
+            all_candidates.extend(candidates)
+
+            # First pass: Check FSNs and collect potential matches
+            for record in candidates:
+                fsn_term = re.sub(r'\(.*?\)', '', record.fsn.lower())
+                matched_concepts.append((fsn_term, record.concept_id))
+                if name.lower() == fsn_term:
+                    metrics.match_total.inc("exact_fsn")
+                    return record.concept_id
+
+            # Second pass: Check synonyms if FSN did not match exactly
+            for record in candidates:
+                for synonym in record.synonyms:
+                    synonym_term = synonym.lower()
+                    synonym_concept_mapping[synonym_term] = record.concept_id
+                    if name.lower() == synonym_term:
+                        metrics.match_total.inc("synonym")
+                        return record.concept_id
+
+        if not matched_concepts:
+            logger.debug("Concept ID not found for diagnostic name '%s'", name)
+            metrics.match_total.inc("none")
+            return None
 
-                # Send only FSN names to Llama for semantic comparison if no synonym matches
-                fsn_list = [fsn for fsn, _ in matched_concepts]
-                query = f"Which of these FSN terms is the closest in meaning to '{name}': {', '.join(fsn_list)}? Provide the answer in the format (in ['']) ['closest term'] or ['None']."
-                print(query)
-                result = run_ollama_medllama2(query)
-                print(result)
-                    
-               # Parse the result to find the closest FSN or None
-                print(matched_concepts)
-                match = re.search(r"\['(.*?)'\]", result)
-                if match:
-                    closest_term = match.group(1).strip().lower()
-                    print(closest_term)
-                    if closest_term != "none":
-                        # Find the concept ID corresponding to the closest FSN term
-                        for fsn_term, concept_id in matched_concepts:
-                            if closest_term == fsn_term.strip():
-                                return concept_id
-                    
-                # If Llama returns 'None' or no match is found, return None
-                print("none")
-                return None
-        else:
-            print(f"Concept ID not found for diagnostic name '{name}'")
+        # Third pass: Check if the name is a subset of any synonyms
+        for synonym_term, concept_id in synonym_concept_mapping.items():
+            if name.lower() in synonym_term:
+                metrics.match_total.inc("substring")
+                return concept_id
+
+        # Rank the candidates locally and only ask Llama when the best match is not clear-cut
+        ranked, confident = fuzzy_rank.best_match(name, [(record.concept_id, (record.fsn,) + record.synonyms) for record in all_candidates])
+        if ranked is not None:
+            logger.debug("Fuzzy match for '%s': '%s' (%s) score %.3f by %s, confident: %s",
+                         name, ranked.term, ranked.concept_id, ranked.score, ranked.method, confident)
+            if confident:
+                metrics.match_total.inc("fuzzy")
+                return ranked.concept_id
+
+        # Send only FSN names to Llama for semantic comparison if no synonym matches
+        if not deadline.allows("llm_closest", deadline.LLM_STAGE_SECONDS, "ollama"):
+            metrics.match_total.inc("none")
             return None
+        fsn_list = [fsn for fsn, _ in matched_concepts]
+        logger.debug("Asking Llama3 for the FSN closest to '%s' among %s", name, fsn_list)
+        with metrics.stage("llm_closest") as stage:
+            result = run_ollama_medllama2(CLOSEST_FSN_PROMPT, name=name, fsn_list=', '.join(fsn_list))
+            stage.hit = result is not None
+        logger.debug("Llama3 answered %r", result)
+
+        # Parse the result to find the closest FSN or None
+        match = re.search(r"\['(.*?)'\]", result)
+        if match:
+            closest_term = match.group(1).strip().lower()
+            if closest_term != "none":
+                # Find the concept ID corresponding to the closest FSN term
+                for fsn_term, concept_id in matched_concepts:
+                    if closest_term == fsn_term.strip():
+                        metrics.match_total.inc("llm_closest")
+                        return concept_id
+
+        # If Llama returns 'None' or no match is found, return None
+        metrics.match_total.inc("none")
+        return None
     except Exception as e:
-        print(f"Error fetching concept ID from Snowstorm server: {e}")
+        logger.warning("Error fetching concept ID from Snowstorm server: %s", e)
         return None
 
 #check if a name is present in the synonyms
@@ -202,8 +187,7 @@ def snomed_code_present(data,corrected_names,current_code,index,row):
                 update_code(data, index, current_code, i)
                 if corrected_name.lower() in map(str.lower, display_names):
                     name_concept_mapping[corrected_name.lower()] = current_code
-                    for name in display_names:
-                        name_concept_mapping[name.lower()] = current_code
+                    name_concept_mapping.update({name.lower(): current_code for name in display_names})
                 else:
                     name_concept_mapping[row['hrgstr_diagnostic_name'].strip().lower()] = current_code
             elif is_display_name_present(corrected_name.lower(), display_names):
@@ -212,7 +196,7 @@ def snomed_code_present(data,corrected_names,current_code,index,row):
                 name_concept_mapping[row['hrgstr_diagnostic_name'].strip()] = current_code
             else:
                 data.at[index, 'correction_status'] = f'Data Mismatch. Code points to {display_names[0]}'
-                print(f"Diagnostic name '{corrected_name}' (entry {index}) not found in display names.")
+                logger.debug("Diagnostic name '%s' (entry %s) not found in display names.", corrected_name, index)
     return data
 
 # Function to extract terms from medllama2 output
@@ -232,80 +216,111 @@ def extract_terms_from_medllama_output(output):
                 terms.append(term)
         return terms
 
-#Manipulating the string to get the code
+#Manipulating the string to get the code. Names the whole cascade could not map are
+#remembered for the current SNOMED release and answered without running it again
 def find_code(corrected_name):
+    release = release_version()
+    with metrics.stage("negative_cache") as stage:
+        stage.hit = release is not None and negative_cache.cache.get(corrected_name, release, "batch")
+    if stage.hit:
+        return (None, "")
+    with metrics.track_failures() as failures, deadline.tracking() as current:
+        result = find_code_uncached(corrected_name)
+    # An outage of Snowstorm or Ollama is not an answer, so those misses are not remembered,
+    # and neither are the ones where a stage was skipped
+    if result[0] is None and release is not None and not failures and not current.skipped:
+        negative_cache.cache.put(corrected_name, release, "batch")
+    return result
+
+def find_code_uncached(corrected_name):
         #Check if code is in dictionary
-        concept_id = name_concept_mapping.get(corrected_name.lower())
+        concept_id = metrics.run_stage("dictionary", name_concept_mapping.get, corrected_name.lower())
         if concept_id == None:
-            # First, try searching the diagnostic name as it is
-            concept_id = get_concept_id(corrected_name)
+            # Exact FSN/synonym matches come from the local RF2 index without a Snowstorm round-trip
+            concept_id = metrics.run_stage("description_index", rf2_index.find_concept, corrected_name)
+        spelled_name = None
         if concept_id == None:
+            # Fix typos against the clinical vocabulary and retry the local lookups
+            with metrics.stage("spelling") as stage:
+                spelled_name = correct_text(corrected_name)
+                if spelled_name == ' '.join(corrected_name.lower().split()):
+                    spelled_name = None
+                else:
+                    concept_id = name_concept_mapping.get(spelled_name) or rf2_index.find_concept(spelled_name)
+                stage.hit = concept_id is not None
+        # The Snowstorm and Llama3 stages are skipped while their circuit breaker is open
+        if concept_id == None and deadline.allows("snowstorm_search", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
+            # First, try searching the diagnostic name as it is
+            concept_id = metrics.run_stage("snowstorm_search", get_concept_id, corrected_name)
+        if concept_id == None and spelled_name is not None and deadline.allows("spelled_search", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
+            # The corrected spelling may find what the name as typed did not
+            concept_id = metrics.run_stage("spelled_search", get_concept_id, spelled_name)
+        if concept_id == None and deadline.allows("concatenated", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
             #join the words, removing the spaces and call snomed server
             word = re.sub(r'\s+', '', corrected_name)
-            concept_id = get_concept_id(word.lower())
+            concept_id = metrics.run_stage("concatenated", get_concept_id, word.lower())
+        if concept_id == None and deadline.allows("segmented", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
+            with metrics.stage("segmented") as stage:
+                word = segment_compound_word(corrected_name.lower())
+                concept_id = get_concept_id(word.lower())
+                stage.hit = concept_id is not None
         if concept_id == None:
-            word = segment_compound_word(corrected_name.lower())
-            concept_id = get_concept_id(word.lower())
+            # Nearest SNOMED description by character n-grams, for misspellings the search misses
+            concept_id = metrics.run_stage("nearest_description", vector_index.find_nearest, corrected_name)
         if concept_id:
             #name_concept_mapping.setdefault(corrected_name.lower(),concept_id)
             #adding all synonyms to the dictionary
             synonyms = get_display_name_from_snowstorm(concept_id)
             name_concept_mapping[corrected_name.lower()] = concept_id
-            for synonym in synonyms:
-                name_concept_mapping[synonym.lower()] = concept_id 
+            name_concept_mapping.update({synonym.lower(): concept_id for synonym in synonyms})
             return (concept_id,"Diagnosis found from SNOMED")
         else:
-            #Check if the words in corrected_name is a subset in any of the elements in dictionary
-            for element,id in name_concept_mapping.items():
-                words = element.lower().split()
-                if corrected_name.lower() in words:
-                    concept_id = id
-                    break
+            #Check if corrected_name is one of the words of any element in the dictionary
+            concept_id = metrics.run_stage("dictionary_word", name_concept_mapping.find_by_token, corrected_name.lower())
             if concept_id == None:
                 #checking the same by removing the spaces
                 word = re.sub(r'\s+', '', corrected_name)
-                concept_id = name_concept_mapping.get(word.lower())
+                concept_id = metrics.run_stage("dictionary_concatenated", name_concept_mapping.get, word.lower())
             if concept_id:
                 #name_concept_mapping.setdefault(corrected_name.lower(),concept_id)
                 #print(f"Added concept_id from dictionary (entry {index}) ")    
                 return (concept_id,"Diagnosis Found in dictionary")
             else:
                 # Check if any of the words in the diagnostic name are present in the name_concept_mapping dictionary
-                for word in corrected_name.split():
-                    concept_id = name_concept_mapping.get(word.lower())
-                    if concept_id:
-                        break  # Break the loop if a match is found
+                with metrics.stage("dictionary_partial") as stage:
+                    for word in corrected_name.split():
+                        concept_id = name_concept_mapping.get(word.lower())
+                        if concept_id:
+                            break  # Break the loop if a match is found
+                    stage.hit = concept_id is not None
                 if concept_id:
                         return (concept_id,'Partial diagnosis name present in dictionary')
                         #print(f"Added concept_id from dictionary (entry {index})")
-                else:
-                    query = (
-                        f"Only provide me the primary disease or condition terms/expand medical abbreviations without any conjunctions or descriptive qualifiers. "
-                        f"If no corrections are needed, return the input as a single term. "
-                        f"Provide the corrected term in the format ['corrected_term']. "
-                        f"Diagnosis: '{corrected_name}'"
-                    )
-                    medllama_output = run_ollama_medllama2(query)
-    
-                    if medllama_output:
-                        corrected_terms = extract_terms_from_medllama_output(medllama_output)
-                        if corrected_terms:
-                            snowstorm_results = []
+                elif deadline.allows("llm_expand", deadline.LLM_STAGE_SECONDS, "ollama"):
+                    with metrics.stage("llm_expand") as stage:
+                        medllama_output = run_ollama_medllama2(EXPAND_PROMPT, diagnosis=corrected_name)
+                        filtered_results = []
+                        if medllama_output:
+                            corrected_terms = extract_terms_from_medllama_output(medllama_output)
+                            logger.debug("Llama3 expanded '%s' to %s", corrected_name, corrected_terms)
                             for term in corrected_terms:
                                 snomed_result = get_concept_id(term)
                                 if snomed_result:
-                                    snowstorm_results.append(snomed_result)
-                            filtered_results = [res for res in snowstorm_results if res is not None]
-                            if filtered_results:
-                                for result in filtered_results:
-                                    synonyms = get_display_name_from_snowstorm(result)
-                                    name_concept_mapping[corrected_name.lower()] = result
-                                    for synonym in synonyms:
-                                        name_concept_mapping[synonym.lower()] = result 
-                                return ', '.join(filtered_results), "Used Llama3 to get the term"
+                                    filtered_results.append(snomed_result)
+                        stage.hit = bool(filtered_results)
+                    if filtered_results:
+                        for result in filtered_results:
+                            synonyms = get_display_name_from_snowstorm(result)
+                            name_concept_mapping[corrected_name.lower()] = result
+                            name_concept_mapping.update({synonym.lower(): result for synonym in synonyms})
+                        return ', '.join(filtered_results), "Used Llama3 to get the term"
 
         return (None, "")
 
+#Splits a diagnosis name on "and", "with" and "," into the names find_code looks up
+def split_names(names):
+    return [name.strip() for name in re.split(r'(?:\s*(?:\band\b|\b,\b|\bwith\b)\s*)+', names, flags=re.IGNORECASE)]
+
 #Splits the word if required and calls fucntions to get the snomed code
 def snomed_code_not_present(data,corrected_names,index,row):
     split_words = corrected_names.lower().split()
@@ -318,11 +333,10 @@ def snomed_code_not_present(data,corrected_names,index,row):
             data.at[index, 'correction_status'] = 'Diagnosis found from SNOMED'
             name_concept_mapping[corrected_names.lower()] = concept_id
             synonyms = get_display_name_from_snowstorm(concept_id)
-            for synonym in synonyms:
-                name_concept_mapping[synonym.lower()] = concept_id
+            name_concept_mapping.update({synonym.lower(): concept_id for synonym in synonyms})
             return data
     #If not, Split the word with "and" "with" "," to get individual diagnosis names
-    corrected_names = [name.strip() for name in re.split(r'(?:\s*(?:\band\b|\b,\b|\bwith\b)\s*)+', corrected_names , flags=re.IGNORECASE)]
+    corrected_names = split_names(corrected_names)
     for i, corrected_name in enumerate(corrected_names):
         #call the find_code function to find the code
         concept_id,correction_status = find_code(corrected_name)
@@ -335,7 +349,6 @@ def snomed_code_not_present(data,corrected_names,index,row):
             if i == 0:
                 data.at[index, 'correction_status'] = 'Primary Concept ID not found'
             elif i == 1:
-                print(corrected_name)
                 data.at[index, 'correction_status'] = 'Secondary Concept ID not found'
             else:
                 # For the third corrected name onwards, append to the existing value with a comma
@@ -345,103 +358,161 @@ def snomed_code_not_present(data,corrected_names,index,row):
                 else:
                     data.at[index, 'concept_id_secondary'] = concept_id
                     data.at[index, 'correction_status'] = 'Secondary Concept ID not found'
-                    print(f"Concept ID not found for diagnostic name '{corrected_name}' (entry {index}).")
-        # Get the current timestamp as a datetime object
-        current_time = datetime.datetime.now()
+                    logger.debug("Concept ID not found for diagnostic name '%s' (entry %s).", corrected_name, index)
 
-        # Format the timestamp as a string
-        formatted_timestamp = current_time.strftime("%Y-%m-%d %H:%M:%S.%f")
-
-        # Print the formatted timestamp
-        print(formatted_timestamp)
-        
     return data
 
-def process_chunk(chunk):
-    chunk['correction_status'] = ''
-    chunk['concept_id_primary'] = ''
-    chunk['concept_id_secondary'] = ''
+NAME_COLUMNS = ['correction_status', 'concept_id_primary', 'concept_id_secondary']
+RESULT_COLUMNS = NAME_COLUMNS + ['Snomed Match?', 'reason for mismatch']
+
+#Cleans the diagnosis names of a whole column: strips whitespace and leading symbols
+def clean_names(names):
+    names = names.fillna('').astype(str).str.strip()
+    return names.str.replace(r'^[^a-zA-Z0-9,]+', '', regex=True)
+
+#Maps one distinct diagnosis name on its own one-row frame so names can be resolved
+#concurrently. Mappings learned on the way are returned instead of saved, see process_chunk
+def resolve_name(name):
+    data = pd.DataFrame({column: [''] for column in NAME_COLUMNS})
+    with name_concept_mapping.deferred() as learned:
+        data = snomed_code_not_present(data, name, 0, None)
+    logger.debug("Name: %s, Concept ID Primary: %s", name, data.at[0, 'concept_id_primary'])
+    return data.loc[0, NAME_COLUMNS], learned
+
+#Explains why a code given in the data differs from the code we found
+def mismatch_reason(code):
+    # Check if the mismatch is because of the given code being an inactive one?
+    if not is_concept_active(code):
+        return "Punjab Data code points to an Inactive concept"
+    # if not, check if it is because the code type of the given concept is not a finding or disorder.
+    elif not check_fsn_type(code):
+        type_ = None
+        display_names = get_display_name_from_snowstorm(code)
+        for name in display_names:
+            match = re.search(r'\(([^)]+)\)', name)
+            if match:
+                type_ = match.group(1)
+                break
+        return f"Punjab Data Code points to a {type_} concept"
+    # If not both of them, it can be our matching error or else a totally wrong code given in the data
+    return "Some other reason for mismatch"
+
+#Maps the chunk resolving every distinct diagnosis name once, on worker threads, and
+#copies the result to all rows with that name. Names read the mapping as it
+#was before the chunk and what they learn is saved afterwards in order of first
+#appearance, so the output is the same whatever the worker count or scheduling
+def process_chunk(chunk, workers=MAPPING_WORKERS):
+    names = clean_names(chunk['hrgstr_diagnostic_name'])
+    # rows whose names differ only in case or spacing share one lookup
+    keys = names.str.lower().str.replace(r'\s+', ' ', regex=True)
+    first = ~keys.duplicated()
+
+    # Score every name the dictionary and the description index do not know in one go,
+    # so the nearest description stage of find_code is a lookup
+    vector_index.prefetch([part for name in names[first] for part in split_names(name)
+                           if name_concept_mapping.get(part.lower()) is None and rf2_index.find_concept(part) is None])
+    # The prompts of the names are batched in row order, see llm_batch.RoundBatcher
+    results = llm_batch.map_batched(resolve_name, names[first], workers)
+    for _, learned in results:
+        name_concept_mapping.update(learned)
+    resolved = pd.DataFrame([values for values, _ in results], index=keys[first].values, columns=NAME_COLUMNS)
+    chunk[NAME_COLUMNS] = resolved.loc[keys.values].to_numpy()
+
+    # If a code is present in the row, compare it with the code found by us
+    codes = chunk['hrgnum_diagnostic_code'].astype(str)
+    has_code = codes.str.isdigit() & (codes != '0')
+    mismatched = has_code & (codes != chunk['concept_id_primary'].astype(str))
     chunk['Snomed Match?'] = ''
-    chunk['reason for mismatch'] = ''
-    
-    for index, row in chunk.iterrows():
-        # get the diagnosis name and code if present in the row
-        current_code = row['hrgnum_diagnostic_code']
-        corrected_names = row['hrgstr_diagnostic_name'].strip()
-        # clean the name
-        corrected_names = re.sub(r'^[^a-zA-Z0-9,]+', '', corrected_names)
-        chunk = snomed_code_not_present(chunk, corrected_names, index, row)
-
-        # Re-fetch the row to ensure we have the updated data
-        row = chunk.loc[index]
-
-        print(f"Index: {index}, Current Code: {current_code}, Concept ID Primary: {row['concept_id_primary']}")
-
-        if str(current_code).isdigit() and str(current_code) != '0':
-            # If code is present in the row, this compares that code with the code found by us.
-            if row['hrgnum_diagnostic_code'] == row['concept_id_primary']:
-                chunk.at[index, 'Snomed Match?'] = "YES"
-            else:
-                chunk.at[index, 'Snomed Match?'] = "NO"
-                # Check if the mismatch is because of the given code being an inactive one?
-                if not is_concept_active(row['hrgnum_diagnostic_code']):
-                    chunk.at[index, 'reason for mismatch'] = "Punjab Data code points to an Inactive concept"
-                # if not, check if it is because the code type of the given concept is not a finding or disorder.
-                elif not check_fsn_type(row['hrgnum_diagnostic_code']):
-                    display_names = get_display_name_from_snowstorm(row['hrgnum_diagnostic_code'])
-                    for name in display_names:
-                        match = re.search(r'\(([^)]+)\)', name)
-                        if match:
-                            type_ = match.group(1)
-                            break
-                    chunk.at[index, 'reason for mismatch'] = f"Punjab Data Code points to a {type_} concept"
-                else:
-                    # If not both of them, it can be our matching error or else a totally wrong code given in the data
-                    chunk.at[index, 'reason for mismatch'] = "Some other reason for mismatch"
+    chunk.loc[has_code, 'Snomed Match?'] = 'YES'
+    chunk.loc[mismatched, 'Snomed Match?'] = 'NO'
+
+    # Work out the reason once per distinct given code
+    mismatched_codes = codes[mismatched].unique().tolist()
+    load_concept_records(mismatched_codes)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reasons = dict(zip(mismatched_codes, executor.map(mismatch_reason, mismatched_codes)))
+    chunk['reason for mismatch'] = codes.map(reasons).where(mismatched, '')
     return chunk
 
-# Reading the CSV and adding columns
-def reading_csv(filename):
-    # Define the number of rows to process
-    num_rows_to_process = 100
-    chunk_size = num_rows_to_process
-    chunks = pd.read_csv(filename, chunksize=chunk_size)
-
-    # Initialize an empty DataFrame to collect processed chunks
-    processed_data = pd.DataFrame()
+INPUT_COLUMNS = ['hrgnum_diagnostic_code', 'gdt_entry_date', 'hrgstr_diagnostic_name']
+INPUT_DTYPES = {column: str for column in INPUT_COLUMNS}
+OUTPUT_COLUMNS = INPUT_COLUMNS + RESULT_COLUMNS
 
-    processed_rows = 0
+#The checkpoint records how many input rows are finished and how long the output was then
+def read_checkpoint(checkpoint_filename):
+    if not os.path.exists(checkpoint_filename):
+        return None
+    with open(checkpoint_filename) as file:
+        return json.load(file)
+
+def write_checkpoint(checkpoint_filename, checkpoint):
+    tmp_filename = checkpoint_filename + '.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_filename, checkpoint_filename)
+
+# Reading the CSV in chunks, appending every processed chunk to the output as it finishes.
+# A killed run picks up after the last finished chunk when it is started again
+def reading_csv(filename, output_filename=None, chunk_size=100, max_rows=None, workers=MAPPING_WORKERS, resume=True):
+    if output_filename is None:
+        output_filename = f"modified_with_llama_method_{max_rows or 'all'}_{os.path.basename(filename)}"
+    checkpoint_filename = output_filename + '.checkpoint'
+
+    checkpoint = read_checkpoint(checkpoint_filename) if resume else None
+    if checkpoint and checkpoint.get('input') == filename and os.path.exists(output_filename):
+        # Drop anything written after the last checkpoint so no chunk appears twice
+        with open(output_filename, 'r+b') as file:
+            file.truncate(checkpoint['output_bytes'])
+        processed_rows = checkpoint['rows_done']
+        logger.info("Resuming %s after row %s", filename, processed_rows)
+    else:
+        open(output_filename, 'w').close()
+        processed_rows = 0
 
+    chunks = pd.read_csv(filename, chunksize=chunk_size, usecols=INPUT_COLUMNS, dtype=INPUT_DTYPES,
+                         skiprows=range(1, processed_rows + 1))
     for chunk in chunks:
-        if processed_rows >= num_rows_to_process:
-            break
-
-        chunk = process_chunk(chunk)
-        processed_data = pd.concat([processed_data, chunk], ignore_index=True)
+        if max_rows is not None:
+            if processed_rows >= max_rows:
+                break
+            chunk = chunk.head(max_rows - processed_rows)
+
+        started = time.perf_counter()
+        chunk = process_chunk(chunk, workers=workers)
+        metrics.chunk_seconds.observe(time.perf_counter() - started)
+        modified_data = chunk[chunk['correction_status'] != '']
+        with open(output_filename, 'a', newline='') as file:
+            modified_data[OUTPUT_COLUMNS].to_csv(file, index=False, header=file.tell() == 0)
+            file.flush()
+            os.fsync(file.fileno())
+            output_bytes = file.tell()
 
         processed_rows += len(chunk)
-        if processed_rows >= num_rows_to_process:
-            processed_data = processed_data.head(num_rows_to_process)
-            break
+        write_checkpoint(checkpoint_filename, {'input': filename, 'rows_done': processed_rows, 'output_bytes': output_bytes})
+        logger.info("Processed %s rows", processed_rows)
 
-    modified_data = processed_data[processed_data['correction_status'] != '']
-    modified_filename = 'modified_with_llama_method_' + str(num_rows_to_process) + '_' + filename
-    # adding the new columns to the csv
-    selected_columns = ['hrgnum_diagnostic_code', 'gdt_entry_date', 'hrgstr_diagnostic_name', 'correction_status', 'concept_id_primary', 'concept_id_secondary', 'Snomed Match?', 'reason for mismatch']
-    modified_data[selected_columns].to_csv(modified_filename, index=False)
-    print("Modified CSV file saved successfully:", modified_filename)
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+    logger.info("Modified CSV file saved successfully: %s", output_filename)
 
+    # The mapping is already saved as it is learned; this writes a CSV snapshot of it
     mapping_filename = 'mapping_dictionary.csv'
-    with open(mapping_filename, 'w', newline="") as file:
-        writer = csv.writer(file)
-        writer.writerow(['corrected_name', 'snomed_concept_id'])
-        for name, concept_id in name_concept_mapping.items():
-            writer.writerow([name, concept_id])
-
-    print("Mapping dictionary saved successfully:", mapping_filename)
-
-# Specify the filename
-filename = 'diagnosis_data.csv'
-
-# Call the function to read the csv
-reading_csv(filename)
+    name_concept_mapping.export_csv(mapping_filename)
+
+    logger.info("Mapping dictionary saved successfully: %s", mapping_filename)
+    logger.info("Run summary\n%s", metrics.summary())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map the diagnosis names of a CSV file to SNOMED CT concepts")
+    parser.add_argument('filename', nargs='?', default='diagnosis_data.csv')
+    parser.add_argument('--output', help="output CSV, defaults to modified_with_llama_method_<max rows>_<filename>")
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--max-rows', type=int, help="stop after this many input rows")
+    parser.add_argument('--workers', type=int, default=MAPPING_WORKERS)
+    parser.add_argument('--no-resume', action='store_true', help="start again instead of resuming from the checkpoint")
+    args = parser.parse_args()
+    metrics.configure_logging()
+
+    # Call the function to read the csv
+    reading_csv(args.filename, output_filename=args.output, chunk_size=args.chunk_size, max_rows=args.max_rows,
+                workers=args.workers, resume=not args.no_resume)
@@ -0,0 +1,57 @@
+import random
+
+# Synthetic diagnosis names in the shapes seen in the hospital data: exact terms in odd
+# casing and spacing, typos, abbreviations, run-together words, combined diagnoses and
+# names no terminology knows. Popular names repeat, as they do in real exports
+
+UNKNOWN_NAMES = ["zqx syndrome", "follow up visit", "review", "kxtr", "old case"]
+
+def _typo(word, rng):
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.choice(("drop", "swap", "replace"))
+    if kind == "drop":
+        return word[:i] + word[i + 1:]
+    if kind == "swap":
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice("aeiou") + word[i + 1:]
+
+def _variant(concept, fixtures, rng):
+    term = rng.choice(concept["synonyms"])
+    kind = rng.choices(("exact", "case", "typo", "joined", "abbreviation", "combined"),
+                       weights=(30, 15, 20, 5, 15, 15))[0]
+    if kind == "case":
+        return "  ".join(term.upper().split()) if rng.random() < 0.5 else term.lower() + " "
+    if kind == "typo":
+        return ' '.join(_typo(word, rng) for word in term.split())
+    if kind == "joined":
+        return term.replace(' ', '')
+    if kind == "abbreviation":
+        abbreviations = [key for key, terms in fixtures["expansions"].items() if term in terms]
+        return rng.choice(abbreviations).upper() if abbreviations else term
+    if kind == "combined":
+        other = rng.choice([c for c in fixtures["concepts"] if c.get("icd10")])
+        return f"{term} {rng.choice(('and', 'with'))} {rng.choice(other['synonyms']).lower()}"
+    return term
+
+#Returns (diagnosis name, given code) pairs. Given codes are mostly right, sometimes
+#missing ('0') and sometimes wrong, so the mismatch reasons are exercised too
+def make_corpus(fixtures, size=300, distinct=120, seed=7):
+    rng = random.Random(seed)
+    concepts = [concept for concept in fixtures["concepts"] if concept.get("icd10")]
+    other_codes = [concept["conceptId"] for concept in fixtures["concepts"] if not concept.get("icd10")]
+    pool = []
+    for _ in range(distinct):
+        if rng.random() < 0.05:
+            pool.append((rng.choice(UNKNOWN_NAMES), '0'))
+            continue
+        concept = rng.choice(concepts)
+        roll = rng.random()
+        code = '0' if roll < 0.2 else rng.choice(other_codes) if roll < 0.3 else concept["conceptId"]
+        pool.append((_variant(concept, fixtures, rng), code))
+    # Zipf-like popularity: the first names of the pool come up far more often
+    weights = [1 / (rank + 1) for rank in range(len(pool))]
+    corpus = pool + rng.choices(pool, weights=weights, k=max(size - len(pool), 0))
+    rng.shuffle(corpus)
+    return corpus[:size]
@@ -0,0 +1,256 @@
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+# End-to-end benchmark of the mapping code against local Snowstorm and Ollama stand-ins.
+#   python benchmarks/run.py                 run every case and compare with the baseline
+#   python benchmarks/run.py --save          run and store the results as the new baseline
+#   python benchmarks/run.py --cases find_code,api --snowstorm-latency 0.02
+# Every case starts from empty caches and an empty learned mapping, and the stores live in
+# a temporary folder, so nothing on this machine is read or changed
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, "baseline.json")
+CASES = ["find_code", "snomed_code_not_present", "process_chunk", "api", "api_batch", "api_burst"]
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+from corpus import make_corpus
+from stubs import StubServers, load_fixtures
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+#Points every module at the stubs and a scratch folder. Must run before they are imported
+def configure_environment(stubs, scratch):
+    os.environ.update({
+        "SNOWSTORM_URL": stubs.snowstorm_url,
+        "OLLAMA_URL": stubs.ollama_url,
+        "MAPPING_DB_PATH": os.path.join(scratch, "name_concept_mapping.db"),
+        "LLM_CACHE_PATH": os.path.join(scratch, "llm_cache.db"),
+        "SNOMED_INDEX_PATH": os.path.join(scratch, "snomed_description_index.idx"),
+        "SNOMED_VECTOR_INDEX_PATH": os.path.join(scratch, "snomed_vector_index"),
+        "SPELLING_VOCABULARY_PATH": os.path.join(scratch, "spelling_vocabulary.txt"),
+        "SINGLE_FLIGHT_PATH": os.path.join(scratch, "single_flight.db"),
+        "ICD10_MAP_PATH": os.path.join(scratch, "icd10_map.pkl"),
+        "API_WARM_UP": "0",
+        "LOG_LEVEL": "WARNING",
+    })
+
+def reset_state():
+    import llm_cache
+    import negative_cache
+    import single_flight
+    import spelling
+    import snowstorm
+    from mapping_store import MappingStore
+    snowstorm.concept_cache.clear()
+    snowstorm._release = (float('-inf'), None)
+    llm_cache.cache.clear()
+    negative_cache.cache.clear()
+    if single_flight.flights.shared is not None:
+        single_flight.flights.shared.clear()
+    MappingStore().clear()
+    spelling._corrector = None
+
+def run_find_code(corpus, args):
+    import Mapping_from_excel as batch
+    timings = []
+    for name, _ in corpus:
+        start = time.perf_counter()
+        batch.find_code(name)
+        timings.append(time.perf_counter() - start)
+    return len(corpus), timings
+
+def run_snomed_code_not_present(corpus, args):
+    import pandas as pd
+    import Mapping_from_excel as batch
+    timings = []
+    for name, _ in corpus:
+        data = pd.DataFrame({column: [''] for column in batch.NAME_COLUMNS})
+        start = time.perf_counter()
+        batch.snomed_code_not_present(data, name, 0, None)
+        timings.append(time.perf_counter() - start)
+    return len(corpus), timings
+
+#Latencies are per chunk here
+def run_process_chunk(corpus, args):
+    import pandas as pd
+    import Mapping_from_excel as batch
+    frame = pd.DataFrame({
+        'hrgnum_diagnostic_code': [code for _, code in corpus],
+        'gdt_entry_date': '2024-01-01',
+        'hrgstr_diagnostic_name': [name for name, _ in corpus],
+    })
+    timings = []
+    for start_row in range(0, len(frame), args.chunk_size):
+        chunk = frame.iloc[start_row:start_row + args.chunk_size].copy()
+        start = time.perf_counter()
+        batch.process_chunk(chunk, workers=args.workers)
+        timings.append(time.perf_counter() - start)
+    return len(corpus), timings
+
+def run_api(corpus, args):
+    from fastapi.testclient import TestClient
+    import terminology_mapping_with_API as api
+    timings = []
+    with TestClient(api.app) as client:
+        for name, _ in corpus:
+            start = time.perf_counter()
+            response = client.post("/get_snomed_code", json={"diagnosis_type": "primary", "diagnostic_term": name})
+            response.raise_for_status()
+            timings.append(time.perf_counter() - start)
+    return len(corpus), timings
+
+#Latencies are per request of args.chunk_size terms here
+def run_api_batch(corpus, args):
+    from fastapi.testclient import TestClient
+    import terminology_mapping_with_API as api
+    timings = []
+    with TestClient(api.app) as client:
+        for start_row in range(0, len(corpus), args.chunk_size):
+            terms = [name for name, _ in corpus[start_row:start_row + args.chunk_size]]
+            start = time.perf_counter()
+            response = client.post("/get_snomed_codes", json={"diagnosis_type": "primary", "diagnostic_terms": terms})
+            response.raise_for_status()
+            lines = response.text.splitlines()
+            timings.append(time.perf_counter() - start)
+            if len(lines) != len(terms):
+                raise RuntimeError(f"Batch endpoint answered {len(lines)} lines for {len(terms)} terms")
+    return len(corpus), timings
+
+#Every distinct name is posted by args.burst clients at the same moment, like a common
+#diagnosis during morning rounds
+def run_api_burst(corpus, args):
+    import asyncio
+    import httpx
+    import snowstorm_async
+    import terminology_mapping_with_API as api
+    names = list(dict.fromkeys(name for name, _ in corpus))
+    timings = []
+
+    async def post(client, name):
+        start = time.perf_counter()
+        response = await client.post("/get_snomed_code", json={"diagnosis_type": "primary", "diagnostic_term": name})
+        response.raise_for_status()
+        timings.append(time.perf_counter() - start)
+
+    async def burst():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://api") as client:
+            for name in names:
+                await asyncio.gather(*(post(client, name) for _ in range(args.burst)))
+        await snowstorm_async.close()
+
+    asyncio.run(burst())
+    return len(names) * args.burst, timings
+
+def run_case(name, corpus, stubs, args):
+    reset_state()
+    calls_before = stubs.snapshot()
+    start = time.perf_counter()
+    terms, timings = globals()[f"run_{name}"](corpus, args)
+    elapsed = time.perf_counter() - start
+    calls = stubs.snapshot()
+    calls.subtract(calls_before)
+    snowstorm_calls = sum(count for kind, count in calls.items() if kind.startswith("snowstorm"))
+    return {
+        "terms": terms,
+        "seconds": round(elapsed, 4),
+        "throughput": round(terms / elapsed, 2),
+        "p50_ms": round(percentile(timings, 50) * 1000, 2),
+        "p95_ms": round(percentile(timings, 95) * 1000, 2),
+        "p99_ms": round(percentile(timings, 99) * 1000, 2),
+        "snowstorm_calls_per_term": round(snowstorm_calls / terms, 3),
+        "ollama_calls_per_term": round(calls["ollama_generate"] / terms, 3),
+        "calls": {kind: count for kind, count in sorted(calls.items()) if count},
+    }
+
+#Returns the names of the measures that got worse than the tolerance allows
+def compare(result, baseline, tolerance):
+    worse = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        worse.append("throughput")
+    for key in ("p95_ms", "snowstorm_calls_per_term", "ollama_calls_per_term"):
+        if result[key] > baseline[key] * (1 + tolerance) + 1e-9:
+            worse.append(key)
+    return worse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the mapping code against local Snowstorm/Ollama stubs")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated, from: " + ", ".join(CASES))
+    parser.add_argument("--terms", type=int, default=300, help="diagnosis names in the corpus")
+    parser.add_argument("--distinct", type=int, default=120, help="distinct names among them")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--burst", type=int, default=8, help="identical requests sent at once in api_burst")
+    parser.add_argument("--snowstorm-latency", type=float, default=0.005, help="seconds added to every Snowstorm response")
+    parser.add_argument("--ollama-latency", type=float, default=0.05, help="seconds added to every Ollama response")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed change over the baseline (0.2 = 20%%)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    cases = [case.strip() for case in args.cases.split(",") if case.strip()]
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    fixtures = load_fixtures()
+    corpus = make_corpus(fixtures, size=args.terms, distinct=args.distinct, seed=args.seed)
+    stubs = StubServers(fixtures, args.snowstorm_latency, args.ollama_latency).start()
+    scratch = tempfile.TemporaryDirectory(prefix="mapping-benchmark-")
+    configure_environment(stubs, scratch.name)
+
+    settings = {key: getattr(args, key) for key in
+                ("terms", "distinct", "seed", "chunk_size", "workers", "burst", "snowstorm_latency", "ollama_latency")}
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("settings") != settings:
+            print("Baseline was recorded with different settings, not comparing")
+            baseline = {}
+
+    results = {}
+    regressions = []
+    print(f"{'case':25s} {'terms/s':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'snowstorm/term':>15s} {'ollama/term':>12s}")
+    try:
+        for case in cases:
+            result = run_case(case, corpus, stubs, args)
+            results[case] = result
+            print(f"{case:25s} {result['throughput']:9.1f} {result['p50_ms']:9.1f} {result['p95_ms']:9.1f} "
+                  f"{result['p99_ms']:9.1f} {result['snowstorm_calls_per_term']:15.2f} {result['ollama_calls_per_term']:12.2f}")
+            if case in baseline.get("results", {}):
+                old = baseline["results"][case]
+                worse = compare(result, old, args.tolerance)
+                print(f"{'':25s} baseline {old['throughput']:.1f} terms/s, p95 {old['p95_ms']:.1f} ms"
+                      + (f"  WORSE: {', '.join(worse)}" if worse else ""))
+                if worse:
+                    regressions.append(case)
+    finally:
+        stubs.stop()
+        scratch.cleanup()
+
+    output = {"settings": settings, "results": results}
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(output, file, indent=2)
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump(output, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
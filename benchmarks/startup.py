@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Start-up time of the batch script and the API, each measured in a fresh interpreter.
+# Run from anywhere:  python benchmarks/startup.py [--save]
+# With --save the medians become the baseline; otherwise they are compared with it and
+# the exit status is 1 when a case got slower than the tolerance allows
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+
+CASES = {
+    "import Mapping_from_excel": "import Mapping_from_excel",
+    "import terminology_mapping_with_API": "import terminology_mapping_with_API",
+    "API warm-up": "import terminology_mapping_with_API as api; api.warm_up()",
+}
+
+def time_case(code, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the start-up time of the mapping code")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown over the baseline (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results = {}
+    regressions = []
+    for name, code in CASES.items():
+        timings = time_case(code, args.repeat)
+        median = statistics.median(timings)
+        results[name] = median
+        line = f"{name:40s} median {median:6.3f}s  min {min(timings):6.3f}s"
+        if name in baseline:
+            change = median / baseline[name] - 1
+            line += f"  baseline {baseline[name]:6.3f}s ({change:+.0%})"
+            if change > args.tolerance:
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"Start-up got slower than the baseline for: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
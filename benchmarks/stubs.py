@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from difflib import SequenceMatcher
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-ins for Snowstorm and Ollama that answer from the recorded fixtures in
+# fixtures/snowstorm.json, with an optional delay on every response, and count the calls
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "snowstorm.json")
+
+def load_fixtures(path=FIXTURES_PATH):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def _words(text):
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+def _fsn_term(fsn):
+    return re.sub(r'\s*\([^()]*\)\s*$', '', fsn).lower()
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _count(self, kind):
+        self.server.stubs.count(kind)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+class _SnowstormHandler(_Handler):
+    def do_GET(self):
+        stubs = self.server.stubs
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        match = re.fullmatch(r"/browser/MAIN/concepts/(\d+)", url.path)
+        if match:
+            self._count("snowstorm_concept")
+            concept = stubs.concepts.get(match.group(1))
+            return self._send(stubs.browser_concept(concept) if concept else {"message": "not found"},
+                              200 if concept else 404)
+        if url.path == "/MAIN/concepts":
+            self._count("snowstorm_search")
+            items = stubs.search(query.get("term", ""), bool(query.get("ecl")))
+            return self._send(self._page(items, query))
+        if url.path == "/MAIN/members":
+            self._count("snowstorm_members")
+            items = stubs.members(query.get("referencedComponentId"))
+            return self._send(self._page(items, query))
+        if url.path == "/codesystems/SNOMEDCT":
+            self._count("snowstorm_codesystem")
+            return self._send({"shortName": "SNOMEDCT", "branchPath": "MAIN",
+                               "latestVersion": {"effectiveDate": stubs.release, "version": stubs.release}})
+        self._send({"message": "not found"}, 404)
+
+    def do_POST(self):
+        stubs = self.server.stubs
+        if self.path == "/browser/MAIN/concepts/bulk-load":
+            self._count("snowstorm_bulk_load")
+            ids = self._body().get("conceptIds", [])
+            return self._send([stubs.browser_concept(stubs.concepts[i]) for i in ids if i in stubs.concepts])
+        self._send({"message": "not found"}, 404)
+
+    #Pages with searchAfter like Snowstorm; the token is simply the next offset
+    def _page(self, items, query):
+        limit = int(query.get("limit", 50))
+        offset = int(query.get("searchAfter", 0))
+        page = items[offset:offset + limit]
+        body = {"items": page, "total": len(items), "limit": limit}
+        if offset + limit < len(items):
+            body["searchAfter"] = str(offset + limit)
+        return body
+
+class _OllamaHandler(_Handler):
+    def do_POST(self):
+        if self.path != "/api/generate":
+            return self._send({"error": "not found"}, 404)
+        prompt = self._body().get("prompt")
+        if not prompt:
+            # keep_alive preload without a prompt
+            return self._send({"done": True})
+        self._count("ollama_generate")
+        self._send({"response": self.server.stubs.answer(prompt), "done": True})
+
+class StubServers:
+    def __init__(self, fixtures=None, snowstorm_latency=0.0, ollama_latency=0.0):
+        fixtures = fixtures or load_fixtures()
+        self.concepts = {concept["conceptId"]: concept for concept in fixtures["concepts"]}
+        self.expansions = {key.lower(): terms for key, terms in fixtures["expansions"].items()}
+        self.release = fixtures.get("release", "20240801")
+        self.snowstorm_latency = snowstorm_latency
+        self.ollama_latency = ollama_latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._servers = []
+
+    def count(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+
+    #Returns a copy of the call counters, e.g. to diff before and after a run
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+    def _serve(self, handler, latency):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        server.stubs = self
+        server.latency = latency
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self._servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def start(self):
+        self.snowstorm_url = self._serve(_SnowstormHandler, self.snowstorm_latency)
+        self.ollama_url = self._serve(_OllamaHandler, self.ollama_latency)
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+    def browser_concept(self, concept):
+        terms = [concept["fsn"]] + concept["synonyms"]
+        return {
+            "conceptId": concept["conceptId"],
+            "active": True,
+            "fsn": {"term": concept["fsn"]},
+            "descriptions": [{"term": term, "active": True} for term in terms],
+        }
+
+    #Word-prefix matching on any description; the clinical finding ECL keeps findings/disorders
+    def search(self, term, clinical_findings_only):
+        words = _words(term)
+        if not words:
+            return []
+        items = []
+        for concept in self.concepts.values():
+            tag = re.search(r'\(([^()]*)\)\s*$', concept["fsn"]).group(1)
+            if clinical_findings_only and tag not in ("disorder", "finding"):
+                continue
+            for description in [concept["fsn"]] + concept["synonyms"]:
+                description_words = _words(description)
+                if all(any(d.startswith(w) for d in description_words) for w in words):
+                    items.append({"conceptId": concept["conceptId"], "active": True,
+                                  "fsn": {"term": concept["fsn"]}, "pt": {"term": concept["synonyms"][0]}})
+                    break
+        return items
+
+    def members(self, concept_id):
+        concepts = [self.concepts[concept_id]] if concept_id in self.concepts else (
+            [] if concept_id else list(self.concepts.values()))
+        return [{"referencedComponentId": concept["conceptId"], "active": True,
+                 "additionalFields": {"mapGroup": "1", "mapPriority": "1", "mapRule": "TRUE",
+                                      "mapTarget": concept["icd10"][0], "mapAdvice": concept["icd10"][1]}}
+                for concept in concepts if concept.get("icd10")]
+
+    def closest(self, name, fsn_list):
+        options = [_fsn_term(c["fsn"]) for c in self.concepts.values() if _fsn_term(c["fsn"]) in fsn_list]
+        if not options:
+            return None
+        return max(options, key=lambda option: SequenceMatcher(None, name.lower(), option).ratio())
+
+    def expand(self, diagnosis):
+        return self.expansions.get(diagnosis.lower().strip(), [diagnosis])
+
+    #Canned answers for the prompt templates of llm_client and their batched forms in llm_batch
+    def answer(self, prompt):
+        match = re.search(r"(?:Diagnoses|Items): (\[.*\])$", prompt, re.S)
+        if match:
+            items = json.loads(match.group(1))
+            if prompt.startswith("For each diagnosis"):
+                answers = [self.expand(diagnosis) for diagnosis in items]
+            else:
+                answers = [self.closest(item["name"], item["fsn_terms"]) for item in items]
+            return json.dumps({"answers": answers})
+        match = re.search(r"closest in meaning to '(.*)': (.*)\? Provide", prompt, re.S)
+        if match:
+            closest = self.closest(match.group(1), match.group(2))
+            return "['%s']" % closest if closest else "['None']"
+        match = re.search(r"Diagnosis: '(.*)'", prompt, re.S)
+        terms = self.expand(match.group(1) if match else prompt)
+        return "[%s]" % ", ".join(f"'{term}'" for term in terms)
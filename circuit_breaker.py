@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+# Stops calling Snowstorm or Ollama for a while once they keep failing or answering too
+# slowly, so requests fail fast instead of each waiting for a timeout. After the pause one
+# call is let through as a probe; its outcome closes the breaker again or restarts the pause
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", "5"))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", "30"))
+# Calls slower than this count as failures
+SLOW_SECONDS = {
+    "snowstorm": float(os.environ.get("SNOWSTORM_SLOW_SECONDS", "5")),
+    "ollama": float(os.environ.get("OLLAMA_SLOW_SECONDS", "60")),
+}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, slow_seconds, failures=CIRCUIT_FAILURES, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self.max_failures = failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None and (self.probing or time.monotonic() - self.opened_at < self.reset_seconds)
+
+    #True when a call may go out; while open only the probe after the pause may
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.probing or self.failures >= self.max_failures:
+                    self.opened_at = time.monotonic()
+            self.probing = False
+
+    #Ends a call whose outcome says nothing about the service without counting it, so a
+    #probe cut short lets the next call probe instead of keeping the breaker open
+    def abandon(self):
+        with self._lock:
+            self.probing = False
+
+breakers = {name: CircuitBreaker(name, seconds) for name, seconds in SLOW_SECONDS.items()}
+
+def is_open(service):
+    breaker = breakers.get(service)
+    return breaker is not None and breaker.is_open()
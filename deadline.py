@@ -0,0 +1,100 @@
+import contextvars
+import math
+import time
+from contextlib import contextmanager
+
+import circuit_breaker
+
+# Latency budget of the request being mapped. The API sets one per request and it follows
+# the work through awaits, asyncio.to_thread and the tasks it starts (contextvars), so the
+# cascade can skip the stages that no longer fit and the outbound calls can shorten their
+# timeouts. Without a budget (the batch script) every stage runs as before
+
+# Seconds a stage needs left in the budget to be started
+SNOWSTORM_STAGE_SECONDS = 0.5
+NEAREST_STAGE_SECONDS = 0.2
+LLM_STAGE_SECONDS = 3.0
+MIN_TIMEOUT = 0.05
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+# Raised in place of a call that could not start within the budget
+class BudgetExceededError(Exception):
+    pass
+
+class Deadline:
+    def __init__(self, expires):
+        self.expires = expires
+        self.skipped = []
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
+
+#Runs the block under a budget ending at the given time.monotonic() value
+@contextmanager
+def until(expires):
+    current = Deadline(expires)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+
+def budget(seconds):
+    return until(time.monotonic() + seconds)
+
+#Yields the current deadline, or an unlimited one for the block when there is none, so
+#the caller can see which stages were skipped inside it
+@contextmanager
+def tracking():
+    current = _current.get()
+    if current is not None:
+        yield current
+    else:
+        with until(math.inf) as current:
+            yield current
+
+#Seconds left in the current budget, or None without one
+def remaining():
+    current = _current.get()
+    if current is None or current.expires == math.inf:
+        return None
+    return current.remaining()
+
+#time.monotonic() value the current budget ends at, math.inf without one
+def expiry():
+    current = _current.get()
+    return current.expires if current is not None else math.inf
+
+def expired():
+    current = _current.get()
+    return current is not None and current.remaining() <= 0
+
+#True when the stage may run: enough of the budget is left and the service it calls is
+#not cut off by its circuit breaker. Otherwise the stage is noted as skipped
+def allows(stage, seconds, service=None):
+    current = _current.get()
+    if service is not None and circuit_breaker.is_open(service):
+        reason = f"{stage} ({service} unavailable)"
+    elif current is not None and current.remaining() < seconds:
+        reason = stage
+    else:
+        return True
+    skip(reason)
+    return False
+
+#Notes a stage (or the reason it did not run) as skipped
+def skip(reason):
+    current = _current.get()
+    if current is not None and reason not in current.skipped:
+        current.skipped.append(reason)
+
+def skipped():
+    current = _current.get()
+    return list(current.skipped) if current is not None else []
+
+#Caps a timeout in seconds to what is left of the budget. HTTP clients refuse a zero
+#timeout, so a spent budget still gives the call a moment
+def timeout(seconds):
+    left = remaining()
+    return seconds if left is None else max(min(seconds, left), MIN_TIMEOUT)
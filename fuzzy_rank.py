@@ -0,0 +1,89 @@
+import re
+from collections import namedtuple
+
+# A match this good, and this far ahead of the next concept, is taken without asking the LLM
+ACCEPT_SCORE = 0.90
+ACCEPT_MARGIN = 0.05
+
+RankResult = namedtuple("RankResult", ["concept_id", "term", "score", "token_sort", "edit", "method"])
+
+# rapidfuzz scores all the terms of a candidate list in one call of compiled code. Without
+# it every term pair is scored in Python, which is many times slower
+try:
+    import numpy
+    from rapidfuzz import fuzz, process
+except ImportError:
+    fuzz = process = None
+
+SEMANTIC_TAG = re.compile(r'\([^()]*\)\s*$')
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+#Lower-cases, drops the semantic tag and turns punctuation into spaces
+def normalize(text):
+    text = SEMANTIC_TAG.sub('', text.lower())
+    return ' '.join(NON_ALPHANUMERIC.sub(' ', text).split())
+
+#Indel similarity 2 * LCS / (len(a) + len(b)), the measure of rapidfuzz's fuzz.ratio, so
+#both backends give the same scores. The longest common subsequence is computed with
+#the bit-parallel algorithm of Hyyro: one integer operation per character of b
+def edit_similarity(a, b):
+    if not a and not b:
+        return 1.0
+    masks = {}
+    for i, char in enumerate(a):
+        masks[char] = masks.get(char, 0) | 1 << i
+    full = (1 << len(a)) - 1
+    row = full
+    for char in b:
+        matches = row & masks.get(char, 0)
+        row = ((row + matches) | (row - matches)) & full
+    common = len(a) - bin(row).count('1')
+    # Same arithmetic as rapidfuzz, percentage included, down to the last bit
+    total = len(a) + len(b)
+    return (1.0 - (total - 2 * common) / total) * 100 / 100
+
+#Token-sort similarity: compares the words of both sides in sorted order, so word order
+#does not matter but words only one side has still lower the score. Token-set
+#similarity would score "diabetes mellitus" 1.0 against "diabetes mellitus type 2"
+def token_sort_similarity(a, b):
+    return edit_similarity(' '.join(sorted(a.split())), ' '.join(sorted(b.split())))
+
+#Returns the token-sort and edit similarities of the query with each of the terms
+def score_terms(query, terms):
+    if process is None:
+        return [token_sort_similarity(query, term) for term in terms], [edit_similarity(query, term) for term in terms]
+    token_sorts = process.cdist([query], terms, scorer=fuzz.token_sort_ratio, dtype=numpy.float64, workers=1)[0] / 100
+    edits = process.cdist([query], terms, scorer=fuzz.ratio, dtype=numpy.float64, workers=1)[0] / 100
+    return token_sorts.tolist(), edits.tolist()
+
+#Scores every concept by its best matching FSN or synonym. candidates is a list of
+#(concept_id, terms); the result is sorted best first
+def rank_candidates(name, candidates):
+    query = normalize(name)
+    pairs = []
+    for concept_id, terms in candidates:
+        for term in terms:
+            normalized = normalize(term)
+            if normalized:
+                pairs.append((concept_id, term, normalized))
+    if not pairs:
+        return []
+    token_sorts, edits = score_terms(query, [normalized for _, _, normalized in pairs])
+    best = {}
+    for (concept_id, term, _), token_sort, edit in zip(pairs, token_sorts, edits):
+        score = (token_sort + edit) / 2
+        if concept_id not in best or score > best[concept_id].score:
+            method = "token_sort" if token_sort >= edit else "edit_distance"
+            best[concept_id] = RankResult(concept_id, term, score, token_sort, edit, method)
+    ranked = list(best.values())
+    ranked.sort(key=lambda result: result.score, reverse=True)
+    return ranked
+
+#Returns (best RankResult or None, whether it is confident enough to skip the LLM)
+def best_match(name, candidates, accept_score=ACCEPT_SCORE, accept_margin=ACCEPT_MARGIN):
+    ranked = rank_candidates(name, candidates)
+    if not ranked:
+        return None, False
+    best = ranked[0]
+    runner_up = ranked[1].score if len(ranked) > 1 else 0.0
+    return best, best.score >= accept_score and best.score - runner_up >= accept_margin
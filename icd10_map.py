@@ -0,0 +1,198 @@
+import bisect
+import glob
+import logging
+import os
+import pickle
+import sys
+import threading
+from collections import namedtuple
+
+import requests
+
+from rf2_index import FSN_TYPE_ID
+from snowstorm import BRANCH, SNOWSTORM_URL, load_concept_records
+
+logger = logging.getLogger(__name__)
+
+ICD10_REFSET_ID = "447562003"
+ICD10_MAP_PATH = os.environ.get("ICD10_MAP_PATH", "icd10_map.pkl")
+FORMAT_VERSION = 4
+
+MapEntry = namedtuple("MapEntry", ["map_group", "map_priority", "map_rule", "map_advice", "map_target"])
+
+#Groups active map rows into concept id -> entries ordered by map group and priority.
+#Entries are kept as plain tuples so the saved table does not depend on this module
+def build_table(rows):
+    table = {}
+    for concept_id, entry in rows:
+        table.setdefault(concept_id, []).append(tuple(entry))
+    return {concept_id: tuple(sorted(entries)) for concept_id, entries in table.items()}
+
+#Reads the active ICD-10 rows of an RF2 ExtendedMap Snapshot file
+def read_rf2_rows(path):
+    with open(path, encoding='utf-8') as file:
+        next(file)
+        for line in file:
+            fields = line.rstrip('\r\n').split('\t')
+            if fields[2] != '1' or fields[4] != ICD10_REFSET_ID:
+                continue
+            yield fields[5], MapEntry(int(fields[6]), int(fields[7]), fields[8], fields[9], fields[10])
+
+#Pages through the whole refset on Snowstorm
+def download_rows(page_size=10000):
+    url = f"{SNOWSTORM_URL}/{BRANCH}/members"
+    params = {"referenceSet": ICD10_REFSET_ID, "active": "true", "limit": page_size}
+    while True:
+        response = requests.get(url, params=params, timeout=120)
+        response.raise_for_status()
+        data = response.json()
+        items = data.get('items', [])
+        for item in items:
+            fields = item.get('additionalFields', {})
+            yield str(item['referencedComponentId']), MapEntry(
+                int(fields.get('mapGroup', 1)), int(fields.get('mapPriority', 1)),
+                fields.get('mapRule'), fields.get('mapAdvice'), fields.get('mapTarget'))
+        search_after = data.get('searchAfter')
+        if not items or not search_after or len(items) < page_size:
+            return
+        params["searchAfter"] = search_after
+
+#Reads the active FSN of every concept in concept_ids from an RF2 Description Snapshot file
+def read_rf2_fsns(path, concept_ids):
+    fsns = {}
+    with open(path, encoding='utf-8') as file:
+        next(file)
+        for line in file:
+            fields = line.rstrip('\r\n').split('\t')
+            if fields[2] == '1' and fields[6] == FSN_TYPE_ID and fields[4] in concept_ids:
+                fsns[fields[4]] = fields[7]
+    return fsns
+
+#Fetches the FSN of every concept in concept_ids from Snowstorm
+def download_fsns(concept_ids):
+    records = load_concept_records(sorted(concept_ids))
+    return {concept_id: record.fsn for concept_id, record in records.items() if record.fsn}
+
+def normalize_code(code):
+    return code.strip().upper()
+
+#Sorted (ICD-10 code, concept id, entry index) keys, one per map entry, for prefix
+#searches from code to concepts
+def build_reverse(table):
+    return sorted((normalize_code(entry[4]), concept_id, i)
+                  for concept_id, entries in table.items() for i, entry in enumerate(entries) if entry[4])
+
+#Brings a reverse index built for old_table up to date with new_table, touching only
+#the concepts whose map changed. Returns the number of changed concepts
+def update_reverse(reverse, old_table, new_table):
+    changed = [concept_id for concept_id in old_table.keys() | new_table.keys()
+               if old_table.get(concept_id) != new_table.get(concept_id)]
+    for concept_id in changed:
+        old_keys = build_reverse({concept_id: old_table.get(concept_id, ())})
+        new_keys = build_reverse({concept_id: new_table.get(concept_id, ())})
+        for key in old_keys:
+            i = bisect.bisect_left(reverse, key)
+            if i < len(reverse) and reverse[i] == key:
+                del reverse[i]
+        for key in new_keys:
+            bisect.insort(reverse, key)
+    return len(changed)
+
+def save_table(table, reverse, fsns, path=ICD10_MAP_PATH):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        pickle.dump({"version": FORMAT_VERSION, "table": table, "reverse": reverse, "fsns": fsns},
+                    file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+#Returns the table, its reverse index and the FSNs of the mapped concepts. Maps saved
+#before the FSNs were kept come back with none, and the reverse index of maps saved
+#before it had one key per entry is rebuilt
+def load_table(path=ICD10_MAP_PATH):
+    with open(path, 'rb') as file:
+        data = pickle.load(file)
+    if data.get("version") not in (1, 2, 3, FORMAT_VERSION):
+        raise ValueError(f"{path} was written by a different version of icd10_map.py")
+    if data["version"] != FORMAT_VERSION:
+        return data["table"], build_reverse(data["table"]), data.get("fsns", {})
+    return data["table"], data["reverse"], data.get("fsns", {})
+
+_table = None
+_reverse = None
+_fsns = {}
+_table_missing = False
+_table_lock = threading.Lock()
+
+#Loads the saved table on first use; returns None when it has not been built
+def get_table():
+    global _table, _reverse, _fsns, _table_missing
+    if _table is None and not _table_missing:
+        with _table_lock:
+            if _table is None and not _table_missing:
+                if os.path.exists(ICD10_MAP_PATH):
+                    _table, _reverse, _fsns = load_table(ICD10_MAP_PATH)
+                else:
+                    _table_missing = True
+                    logger.info("ICD-10 map %s not found, using Snowstorm for ICD-10 codes", ICD10_MAP_PATH)
+    return _table
+
+#Returns the map entries of a concept, or None when the table is not available
+def get_map_entries(concept_id):
+    table = get_table()
+    if table is None:
+        return None
+    return [MapEntry(*entry) for entry in table.get(str(concept_id), ())]
+
+#Returns the FSN saved with the map for a mapped concept, or None
+def get_fsn(concept_id):
+    if get_table() is None:
+        return None
+    return _fsns.get(str(concept_id))
+
+#Finds the concepts mapped to an ICD-10 code or code prefix ("R32", "E11", "E11.*").
+#Returns the total number of map entries matched and one page of them, as (concept id,
+#MapEntry) pairs, or None without a table
+def find_concepts(code, offset=0, limit=50):
+    table = get_table()
+    if table is None:
+        return None
+    prefix = normalize_code(code).rstrip('*').rstrip('.')
+    start = bisect.bisect_left(_reverse, (prefix,))
+    end = bisect.bisect_left(_reverse, (prefix + '\uffff',))
+    matches = [(concept_id, MapEntry(*table[concept_id][i]))
+               for _, concept_id, i in _reverse[start + offset:min(end, start + offset + limit)]]
+    return end - start, matches
+
+#python icd10_map.py rf2 <RF2 release folder>  or  python icd10_map.py snowstorm
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ("rf2", "snowstorm") or (argv[1] == "rf2" and len(argv) < 3):
+        print("Usage: python icd10_map.py rf2 <RF2 release folder> | python icd10_map.py snowstorm")
+        return 1
+    if argv[1] == "rf2":
+        files = glob.glob(os.path.join(argv[2], "**", "der2_iisssccRefset_ExtendedMapSnapshot_*.txt"), recursive=True)
+        if not files:
+            print(f"No RF2 ExtendedMap Snapshot file found under {argv[2]}")
+            return 1
+        table = build_table(read_rf2_rows(files[0]))
+        # The FSNs are saved with the map so reverse lookups do not need Snowstorm
+        descriptions = glob.glob(os.path.join(argv[2], "**", "sct2_Description_Snapshot*.txt"), recursive=True)
+        if not descriptions:
+            print(f"No RF2 Description Snapshot file found under {argv[2]}")
+            return 1
+        fsns = read_rf2_fsns(descriptions[0], table.keys())
+    else:
+        table = build_table(download_rows())
+        fsns = download_fsns(table.keys())
+    if os.path.exists(ICD10_MAP_PATH):
+        # Only the concepts whose map changed since the saved release are re-indexed
+        old_table, reverse, _ = load_table(ICD10_MAP_PATH)
+        changed = update_reverse(reverse, old_table, table)
+        print(f"{changed} concepts changed since the saved map")
+    else:
+        reverse = build_reverse(table)
+    save_table(table, reverse, fsns)
+    print(f"Saved ICD-10 maps for {len(table)} concepts to {ICD10_MAP_PATH}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
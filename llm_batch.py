@@ -0,0 +1,319 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import deadline
+import llm_client
+import metrics
+from llm_client import CLOSEST_FSN_PROMPT, EXPAND_PROMPT, LLM_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Groups expansion and closest-FSN prompts into one prompt holding a JSON array of items,
+# since most of a prompt's cost is fixed. Each answer is turned back into what the single
+# prompt would have answered, so callers and the LLM cache see no difference. Items whose
+# answer is missing or malformed are asked on their own. The batch script groups the
+# prompts of a chunk in row order (RoundBatcher), so its output does not depend on thread
+# timing; the API groups the prompts of requests arriving together (AsyncMicroBatcher)
+LLM_BATCH_SIZE = int(os.environ.get("LLM_BATCH_SIZE", "8"))
+# Seconds the first prompt of an API batch waits for others to join it
+LLM_BATCH_WAIT = float(os.environ.get("LLM_BATCH_WAIT", "0.02"))
+# Tokens the model may generate per item of a batch
+TOKENS_PER_ITEM = 96
+
+EXPAND_BATCH_PROMPT = (
+    "For each diagnosis in the JSON array below, give only the primary disease or condition terms and expand medical abbreviations, "
+    "without any conjunctions or descriptive qualifiers. If no corrections are needed, give the diagnosis itself as the single term. "
+    'Answer with a JSON object {{"answers": [...]}} holding one list of terms per diagnosis, in the same order. '
+    "Diagnoses: {items}"
+)
+CLOSEST_FSN_BATCH_PROMPT = (
+    "For each item in the JSON array below, pick the FSN term from its \"fsn_terms\" that is the closest in meaning to its \"name\", "
+    "or null when none is. "
+    'Answer with a JSON object {{"answers": [...]}} holding one FSN term or null per item, in the same order. '
+    "Items: {items}"
+)
+
+def _expand_item(inputs):
+    return inputs["diagnosis"]
+
+#Returns the answer in the format of EXPAND_PROMPT, or None when it is malformed
+def _expand_answer(answer):
+    if isinstance(answer, str):
+        answer = [answer]
+    if not isinstance(answer, list) or not answer or not all(isinstance(term, str) and term.strip() for term in answer):
+        return None
+    return "[%s]" % ", ".join(f"'{term.strip()}'" for term in answer)
+
+def _closest_item(inputs):
+    return {"name": inputs["name"], "fsn_terms": inputs["fsn_list"]}
+
+def _closest_answer(answer):
+    if answer is None or (isinstance(answer, str) and answer.strip().lower() in ("", "none", "null")):
+        return "['None']"
+    if not isinstance(answer, str):
+        return None
+    return f"['{answer.strip()}']"
+
+# Single prompt template -> (batch template, item builder, answer converter)
+BATCH_PROMPTS = {
+    EXPAND_PROMPT: (EXPAND_BATCH_PROMPT, _expand_item, _expand_answer),
+    CLOSEST_FSN_PROMPT: (CLOSEST_FSN_BATCH_PROMPT, _closest_item, _closest_answer),
+}
+
+#Pulls the list of answers out of a batch response: a bare JSON array or the first
+#array inside a JSON object
+def parse_answers(output):
+    try:
+        data = json.loads(output)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(data, dict):
+        data = data.get("answers", next((value for value in data.values() if isinstance(value, list)), None))
+    return data if isinstance(data, list) else None
+
+#Answers the items with one prompt, or with the single prompt when there is one item
+def _send(template, items):
+    if len(items) == 1:
+        items[0].response = llm_client.generate(template.format(**items[0].inputs))
+        return
+    batch_template, make_item, convert = BATCH_PROMPTS[template]
+    prompt = batch_template.format(items=json.dumps([make_item(item.inputs) for item in items]))
+    output = llm_client.generate(prompt, json_format=True, num_predict=TOKENS_PER_ITEM * len(items))
+    answers = parse_answers(output) if output is not None else None
+    if answers is not None and len(answers) != len(items):
+        # Answers cannot be matched to items safely when some are missing
+        logger.debug("Batch of %d prompts got %d answers", len(items), len(answers))
+        answers = None
+    failed = []
+    for i, item in enumerate(items):
+        item.response = convert(answers[i]) if answers is not None else None
+        if item.response is None:
+            failed.append(item)
+    metrics.llm_batch_items.inc("batched", amount=len(items) - len(failed))
+    if failed:
+        metrics.llm_batch_items.inc("fallback", amount=len(failed))
+        logger.debug("Asking %d of %d batched prompts one by one", len(failed), len(items))
+    for item in failed:
+        item.response = llm_client.generate(template.format(**item.inputs))
+
+class _Item:
+    __slots__ = ("inputs", "expires", "response", "failed", "done", "abandoned")
+
+    def __init__(self, inputs, done=None):
+        self.inputs = inputs
+        # End of the caller's budget
+        self.expires = deadline.expiry()
+        self.response = None
+        # Set when every call made for the item failed
+        self.failed = False
+        self.done = done if done is not None else threading.Event()
+        # Set when the caller stopped waiting before the batch was sent
+        self.abandoned = False
+
+class _Batch:
+    def __init__(self, full):
+        self.items = []
+        self.full = full
+
+# State of one RoundBatcher.map call
+class _Run:
+    def __init__(self, values, workers):
+        self.values = values
+        self.results = [None] * len(values)
+        self.error = None
+        # Values computed at the same time
+        self.slots = threading.Semaphore(workers)
+        # Values that are neither waiting for an answer nor finished
+        self.active = len(values)
+        # (value index, template, key, item) of the prompts waiting for the next round
+        self.waiting = []
+        # Answers of the earlier rounds by prompt key, so a prompt asked again later in the
+        # chunk is answered the same way whether or not the LLM cache has it yet
+        self.answers = {}
+        self.lock = threading.Lock()
+
+_local = threading.local()
+
+# The batch script's batcher. map() resolves every value on a thread of its own, with at
+# most `workers` of them computing at a time, and the prompts they ask are sent in rounds:
+# once every value waits for an answer or is finished, the waiting prompts are sent in the
+# order of their values, in groups of batch_size. A round thus holds the next prompt of
+# every unfinished value, whatever the thread timing or worker count, so a chunk is mapped
+# the same way on every run
+class RoundBatcher:
+    def __init__(self, batch_size=LLM_BATCH_SIZE, concurrency=LLM_CONCURRENCY):
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm-round")
+
+    #Returns [function(value) for value in values]
+    def map(self, function, values, workers):
+        values = list(values)
+        run = _Run(values, max(workers, 1))
+        threads = [threading.Thread(target=self._work, args=(run, function, index)) for index in range(len(values))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if run.error is not None:
+            raise run.error
+        return run.results
+
+    def _work(self, run, function, index):
+        _local.run, _local.index = run, index
+        run.slots.acquire()
+        try:
+            run.results[index] = function(run.values[index])
+        except BaseException as e:
+            with run.lock:
+                run.error = run.error or e
+        finally:
+            run.slots.release()
+            _local.run = None
+            self._deactivate(run)
+
+    #Notes that a value stopped computing; the last one to stop sends the round
+    def _deactivate(self, run):
+        with run.lock:
+            run.active -= 1
+            flush = run.active == 0 and bool(run.waiting)
+        if flush:
+            self._flush(run)
+
+    #Answers one prompt from inside map(), in the next round
+    def generate(self, template, inputs, key):
+        run = _local.run
+        with run.lock:
+            if key in run.answers:
+                return run.answers[key]
+            item = _Item(inputs)
+            run.waiting.append((_local.index, template, key, item))
+        run.slots.release()
+        self._deactivate(run)
+        item.done.wait()
+        run.slots.acquire()
+        if item.failed:
+            # The calls ran in the batcher's threads, outside this thread's track_failures
+            metrics.note_failure("ollama", "generate")
+        return item.response
+
+    #Sends the waiting prompts. Only runs while no value is computing
+    def _flush(self, run):
+        with run.lock:
+            waiting, run.waiting = sorted(run.waiting, key=lambda entry: entry[0]), []
+        # Identical prompts are asked once
+        unique = {}
+        for _, template, key, item in waiting:
+            unique.setdefault((template, key), item)
+        groups = []
+        for template in dict.fromkeys(template for template, _ in unique):
+            items = [item for (other, _), item in unique.items() if other == template]
+            size = self.batch_size if template in BATCH_PROMPTS else 1
+            groups.extend((template, items[start:start + size]) for start in range(0, len(items), size))
+        for future in [self._executor.submit(_send, template, items) for template, items in groups]:
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Error sending a batch of prompts")
+        with run.lock:
+            for (_, key), item in unique.items():
+                if item.response is not None:
+                    run.answers[key] = item.response
+            run.active += len(waiting)
+        for _, template, key, item in waiting:
+            sent = unique[(template, key)]
+            item.response = sent.response
+            item.failed = sent.response is None
+            item.done.set()
+
+# The API's micro-batcher. It runs on the event loop, so prompts waiting for their batch or
+# for a free slot hold no thread; only the LLM_CONCURRENCY threads of its own pool block
+# on Ollama, and the asyncio.to_thread pool stays free for the rest of the requests
+class AsyncMicroBatcher:
+    def __init__(self, batch_size=LLM_BATCH_SIZE, wait=LLM_BATCH_WAIT, concurrency=LLM_CONCURRENCY):
+        self.batch_size = batch_size
+        self.wait = wait
+        self.concurrency = concurrency
+        self._open = {}
+        self._loop = None
+        self._slots = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm")
+
+    #Answers one prompt. A caller whose budget runs out first gets None and the stage it
+    #runs in is noted as skipped
+    async def generate(self, template, inputs):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio primitives belong to one event loop
+            self._loop, self._slots, self._open = loop, asyncio.Semaphore(self.concurrency), {}
+        item = _Item(inputs, loop.create_future())
+        batch = self._open.get(template)
+        if batch is None:
+            batch = self._open[template] = _Batch(asyncio.Event())
+            asyncio.ensure_future(self._dispatch(template, batch))
+        batch.items.append(item)
+        if len(batch.items) >= self.batch_size or template not in BATCH_PROMPTS:
+            del self._open[template]
+            batch.full.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(item.done), deadline.remaining())
+        except asyncio.TimeoutError:
+            deadline.skip(metrics.current_stage() or "llm")
+            return None
+        finally:
+            if not item.done.done():
+                item.abandoned = True
+        if item.failed:
+            # The calls ran in the batcher's threads, outside this caller's track_failures
+            metrics.note_failure("ollama", "generate")
+        return item.response
+
+    async def _dispatch(self, template, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.wait)
+        except asyncio.TimeoutError:
+            pass
+        # While every slot is taken the batch stays open, so the prompts arriving meanwhile
+        # join it rather than queueing small batches of their own
+        async with self._slots:
+            if self._open.get(template) is batch:
+                del self._open[template]
+            items = [item for item in batch.items if not item.abandoned]
+            try:
+                if items:
+                    # The calls may take as long as the longest budget among the callers
+                    expires = max(item.expires for item in items)
+                    await asyncio.get_running_loop().run_in_executor(self._executor, _send_until, template, items, expires)
+            except Exception:
+                logger.exception("Error sending a batch of %d prompts", len(items))
+            finally:
+                for item in batch.items:
+                    item.failed = item.response is None
+                    if not item.done.done():
+                        item.done.set_result(None)
+
+def _send_until(template, items, expires):
+    with deadline.until(expires):
+        _send(template, items)
+
+round_batcher = RoundBatcher()
+async_batcher = AsyncMicroBatcher()
+
+#Runs function over the values on worker threads, batching their prompts, see RoundBatcher
+def map_batched(function, values, workers):
+    return round_batcher.map(function, values, workers)
+
+#Answers a prompt; key identifies it (the LLM cache key). Prompts asked from inside
+#map_batched are batched with the other values' prompts, others are sent on their own.
+#Single prompts do not depend on grouping, so they skip the rounds
+def generate(template, inputs, key):
+    if getattr(_local, 'run', None) is not None and round_batcher.batch_size > 1:
+        return round_batcher.generate(template, inputs, key)
+    return llm_client.generate(template.format(**inputs))
+
+#generate for the event loop, see AsyncMicroBatcher
+async def generate_async(template, inputs):
+    return await async_batcher.generate(template, inputs)
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import llm_batch
+import llm_client
+import metrics
+
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.db")
+MAX_ENTRIES = 100000
+MAX_AGE = 30 * 24 * 60 * 60
+# How many inserts happen between eviction sweeps
+EVICT_EVERY = 500
+
+#Lower-cases and collapses whitespace so "Urinary  incontinent" and "urinary incontinent" share an entry
+def normalize_input(value):
+    return ' '.join(str(value).lower().split())
+
+def make_key(model, template, inputs):
+    normalized = {name: normalize_input(value) for name, value in inputs.items()}
+    raw = json.dumps([model, template, normalized], sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+# Persistent cache of LLM answers stored in SQLite, shared across runs and API restarts
+class LLMCache:
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=MAX_ENTRIES, max_age=MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_used REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache(last_used)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute("SELECT response, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < now - self.max_age:
+            with self._lock:
+                self.misses += 1
+            return None
+        with conn:
+            conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, model, response):
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+        with self._lock:
+            self._inserts += 1
+            sweep = self._inserts % EVICT_EVERY == 0
+        if sweep:
+            self.evict()
+
+    #Drops expired entries and then the least recently used ones above max_entries
+    def evict(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.max_age,))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        total = self.hits + self.misses
+        size = self._connection().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": size,
+        }
+
+cache = LLMCache()
+metrics.register_cache("llm", cache)
+
+#Fills the template with the inputs and asks the LLM, answering from the cache when
+#the same template was already run for the same normalized inputs. Misses asked from the
+#batch script's workers are batched with the other names of the chunk (llm_batch.py)
+def cached_generate(template, **inputs):
+    model = llm_client.client.model
+    key = make_key(model, template, inputs)
+    response = cache.get(key)
+    if response is not None:
+        return response
+    response = llm_batch.generate(template, inputs, key)
+    if response is not None:
+        cache.put(key, model, response)
+    return response
+
+#cached_generate for the event loop. The SQLite lookups run in a thread and the prompt goes
+#through the async micro-batcher, so no thread waits on Ollama for the caller
+async def cached_generate_async(template, **inputs):
+    model = llm_client.client.model
+    key = make_key(model, template, inputs)
+    response = await asyncio.to_thread(cache.get, key)
+    if response is not None:
+        return response
+    response = await llm_batch.generate_async(template, inputs)
+    if response is not None:
+        await asyncio.to_thread(cache.put, key, model, response)
+    return response
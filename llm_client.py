@@ -0,0 +1,86 @@
+import logging
+import os
+import requests
+import threading
+
+import deadline
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3")
+
+# Keeps the model resident in Ollama between prompts
+KEEP_ALIVE = "30m"
+# Upper bound on prompts in flight to Ollama across all worker threads
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "2"))
+# Seconds allowed for connecting and for a whole generation
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 120
+
+DEFAULT_OPTIONS = {
+    "temperature": 0,
+    "num_predict": 256,
+}
+
+# Prompt templates shared by the batch script and the API
+CLOSEST_FSN_PROMPT = "Which of these FSN terms is the closest in meaning to '{name}': {fsn_list}? Provide the answer in the format (in ['']) ['closest term'] or ['None']."
+EXPAND_PROMPT = (
+    "Only provide me the primary disease or condition terms/expand medical abbreviations without any conjunctions or descriptive qualifiers. "
+    "If no corrections are needed, return the input as a single term. "
+    "Provide the corrected term in the format ['corrected_term']. "
+    "Diagnosis: '{diagnosis}'"
+)
+
+# Talks to the local Ollama HTTP API over a keep-alive session instead of
+# starting `ollama run` for every prompt
+class OllamaClient:
+    def __init__(self, base_url=OLLAMA_URL, model=OLLAMA_MODEL, options=None,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.options = dict(DEFAULT_OPTIONS, **(options or {}))
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.slots = threading.BoundedSemaphore(LLM_CONCURRENCY)
+
+    #Sends one prompt and returns the generated text, or None on failure.
+    #json_format asks Ollama to constrain the answer to valid JSON
+    def generate(self, prompt, json_format=False, **options):
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": KEEP_ALIVE,
+            "options": dict(self.options, **options),
+        }
+        if json_format:
+            payload["format"] = "json"
+        try:
+            connect_timeout, read_timeout = self.timeout
+            with metrics.outbound("ollama", "generate", self.slots) as call:
+                # A request budget cuts a slow generation short
+                response = self.session.post(f"{self.base_url}/api/generate", json=payload,
+                                             timeout=(connect_timeout, deadline.timeout(read_timeout)))
+                call.failed = response.status_code != 200
+            if response.status_code != 200:
+                logger.warning("Ollama returned status %s: %s", response.status_code, response.text)
+                return None
+            return response.json().get('response', '').strip()
+        except Exception as e:
+            logger.warning("Error calling Ollama: %s", e)
+            return None
+
+    #Loads the model ahead of the first prompt so it does not pay the load time
+    def warm_up(self):
+        try:
+            self.session.post(f"{self.base_url}/api/generate",
+                              json={"model": self.model, "keep_alive": KEEP_ALIVE}, timeout=self.timeout)
+        except Exception as e:
+            logger.warning("Could not preload %s in Ollama: %s", self.model, e)
+
+client = OllamaClient()
+
+def generate(prompt, json_format=False, **options):
+    return client.generate(prompt, json_format=json_format, **options)
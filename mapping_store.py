@@ -0,0 +1,154 @@
+import csv
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+import negative_cache
+
+MAPPING_DB_PATH = os.environ.get("MAPPING_DB_PATH", "name_concept_mapping.db")
+
+def _token_rows(names):
+    for name in names:
+        for token in set(name.lower().split()):
+            yield (token, name)
+
+# Persistent name -> concept id mapping kept in SQLite (WAL mode) so the batch job
+# and every API worker share what they learn, and nothing is lost on a crash.
+# It behaves like the dict it replaces; the connection is opened on first use.
+class MappingStore:
+    def __init__(self, path=MAPPING_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS mapping (name TEXT PRIMARY KEY, concept_id TEXT NOT NULL)")
+            # Inverted index from each word of a name to the names containing it
+            has_tokens = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mapping_tokens'").fetchone()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS mapping_tokens ("
+                "token TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (token, name)) WITHOUT ROWID"
+            )
+            if not has_tokens:
+                names = [name for (name,) in conn.execute("SELECT name FROM mapping")]
+                conn.executemany("INSERT OR IGNORE INTO mapping_tokens (token, name) VALUES (?, ?)",
+                                 _token_rows(names))
+            negative_cache.create_tables(conn)
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _pending(self):
+        return getattr(self._local, 'pending', None)
+
+    #Collects the writes made by this thread instead of committing them, so a batch can
+    #save them later in a fixed order. Reads in this thread still see them
+    @contextmanager
+    def deferred(self):
+        pending = {}
+        self._local.pending = pending
+        try:
+            yield pending
+        finally:
+            self._local.pending = None
+
+    def get(self, name, default=None):
+        pending = self._pending()
+        if pending and name in pending:
+            return pending[name]
+        row = self._connection().execute("SELECT concept_id FROM mapping WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def __getitem__(self, name):
+        concept_id = self.get(name)
+        if concept_id is None:
+            raise KeyError(name)
+        return concept_id
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __setitem__(self, name, concept_id):
+        self.update({name: concept_id})
+
+    #Writes several names in one transaction; existing names keep their position
+    def update(self, mapping):
+        rows = [(name, str(concept_id)) for name, concept_id in dict(mapping).items()]
+        if not rows:
+            return
+        pending = self._pending()
+        if pending is not None:
+            pending.update(rows)
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO mapping (name, concept_id) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET concept_id = excluded.concept_id",
+                rows,
+            )
+            conn.executemany("INSERT OR IGNORE INTO mapping_tokens (token, name) VALUES (?, ?)",
+                             _token_rows(name for name, _ in rows))
+            # Terms that were unmappable may resolve through these names now
+            negative_cache.invalidate(conn, [name for name, _ in rows])
+
+    #Returns the concept id of the first learned name containing the word, or None
+    def find_by_token(self, token):
+        row = self._connection().execute(
+            "SELECT m.concept_id FROM mapping_tokens t JOIN mapping m ON m.name = t.name "
+            "WHERE t.token = ? ORDER BY m.rowid LIMIT 1",
+            (token.lower(),),
+        ).fetchone()
+        if row is None:
+            for name, concept_id in (self._pending() or {}).items():
+                if token.lower() in name.lower().split():
+                    return concept_id
+            return None
+        return row[0]
+
+    #Returns (name, concept_id) pairs in the order the names were first learned
+    def items(self):
+        return self._connection().execute("SELECT name, concept_id FROM mapping ORDER BY rowid").fetchall()
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM mapping").fetchone()[0]
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM mapping")
+            conn.execute("DELETE FROM mapping_tokens")
+
+    #Loads a mapping_dictionary.csv written by earlier runs
+    def import_csv(self, filename):
+        with open(filename, newline="", encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            mapping = {row[0]: row[1] for row in reader if len(row) >= 2 and row[0] and row[1]}
+        self.update(mapping)
+        return len(mapping)
+
+    def export_csv(self, filename):
+        with open(filename, 'w', newline="", encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(['corrected_name', 'snomed_concept_id'])
+            for name, concept_id in self.items():
+                writer.writerow([name, concept_id])
+
+#python mapping_store.py mapping_dictionary.csv [more.csv ...] imports old dictionaries
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python mapping_store.py <mapping_dictionary.csv> [...]")
+        sys.exit(1)
+    store = MappingStore()
+    for filename in sys.argv[1:]:
+        print(f"Imported {store.import_csv(filename)} names from {filename} into {store.path}")
@@ -0,0 +1,274 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import circuit_breaker
+import deadline
+
+# In-process counters and latency histograms for the mapping cascade, the calls to
+# Snowstorm and Ollama and the caches. The API serves them in the Prometheus text format
+# on /metrics and the batch script logs a summary at the end of a run
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# MAPPING_TRACE=1 logs every candidate list, prompt and LLM answer (DEBUG level)
+MAPPING_TRACE = os.environ.get("MAPPING_TRACE", "0") == "1"
+
+#Sets up logging for the scripts; tracing lowers the level to DEBUG
+def configure_logging():
+    logging.basicConfig(level=logging.DEBUG if MAPPING_TRACE else LOG_LEVEL,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # httpx logs every request at INFO; the outbound metrics already count them
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+_registry = []
+_caches = {}
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    #Returns label values -> (count, sum)
+    def totals(self):
+        with self._lock:
+            return {label_values: (entry[2], entry[1]) for label_values, entry in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = {label_values: (list(entry[0]), entry[1], entry[2]) for label_values, entry in self._values.items()}
+        for label_values, (bucket_counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, label_values, [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values, ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+stage_total = Counter("mapping_stage_total", "Lookups per cascade stage and whether they found a concept", ("stage", "outcome"))
+stage_seconds = Histogram("mapping_stage_seconds", "Time spent in each cascade stage", ("stage",))
+match_total = Counter("mapping_match_total", "Concepts chosen by each pass of get_concept_id", ("method",))
+outbound_seconds = Histogram("outbound_request_seconds", "Duration of the calls to Snowstorm and Ollama", ("service", "endpoint"))
+chunk_seconds = Histogram("batch_chunk_seconds", "Time to map one chunk of the batch script")
+outbound_errors = Counter("outbound_errors_total", "Calls to Snowstorm and Ollama that raised an error or a server error status", ("service", "endpoint"))
+llm_batch_items = Counter("llm_batch_items_total", "Prompts answered inside a multi-item prompt, or asked again on their own", ("outcome",))
+coalesced_total = Counter("single_flight_coalesced_total", "API requests answered by another request's resolution of the same term", ("scope",))
+
+_failures = contextvars.ContextVar("outbound_failures", default=None)
+# Name of the cascade stage the current code runs in
+_stage = contextvars.ContextVar("stage", default=None)
+
+#Caches with hits and misses attributes, reported as cache_hits_total/cache_misses_total
+def register_cache(name, cache):
+    _caches[name] = cache
+
+class _Stage:
+    __slots__ = ("hit",)
+
+    def __init__(self):
+        self.hit = False
+
+#Times a block of the cascade; set .hit on the yielded object when it found a concept
+@contextmanager
+def stage(name):
+    current = _Stage()
+    token = _stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        _stage.reset(token)
+        stage_seconds.observe(time.perf_counter() - start, name)
+        stage_total.inc(name, "hit" if current.hit else "miss")
+
+def current_stage():
+    return _stage.get()
+
+#Runs function(*args) as a stage that hits when it returns something other than None
+def run_stage(name, function, *args):
+    with stage(name) as current:
+        result = function(*args)
+        current.hit = result is not None
+    return result
+
+async def run_stage_async(name, function, *args):
+    with stage(name) as current:
+        result = await function(*args)
+        current.hit = result is not None
+    return result
+
+#Counts a failed outbound call and notes it for the enclosing track_failures block
+def record_failure(service, endpoint):
+    outbound_errors.inc(service, endpoint)
+    note_failure(service, endpoint)
+
+#Notes, without counting it again, a failed call that another thread made on this
+#caller's behalf
+def note_failure(service, endpoint):
+    failures = _failures.get()
+    if failures is not None:
+        failures.append((service, endpoint))
+
+#Collects the (service, endpoint) of the calls that fail inside the block, so a caller
+#can tell "nothing matched" apart from "Snowstorm or Ollama did not answer"
+@contextmanager
+def track_failures():
+    failures = []
+    token = _failures.set(failures)
+    try:
+        yield failures
+    finally:
+        _failures.reset(token)
+
+class _Call:
+    __slots__ = ("failed",)
+
+    def __init__(self):
+        self.failed = False
+
+    #Marks the call failed on a server error status
+    def check(self, status_code):
+        self.failed = status_code >= 500
+
+#Notes the stage that found no free slot for a call to the service within the request
+#budget as skipped, and returns the error to raise in place of the call
+def slot_timeout(service, endpoint):
+    deadline.skip(_stage.get() or f"{service}_{endpoint}")
+    return deadline.BudgetExceededError(f"No free {service} slot within the request budget")
+
+#Times one outbound call and feeds the service's circuit breaker. The call first takes
+#one of the service's slots (a threading semaphore), waiting no longer than the request
+#budget allows, see slot_timeout. Raises CircuitOpenError without calling while the
+#breaker is open. Errors are counted and re-raised; set .failed on the yielded object
+#for an answer that is an error (see check)
+@contextmanager
+def outbound(service, endpoint, slots=None):
+    if slots is not None and not slots.acquire(timeout=deadline.remaining()):
+        raise slot_timeout(service, endpoint)
+    try:
+        with _outbound(service, endpoint) as call:
+            yield call
+    finally:
+        if slots is not None:
+            slots.release()
+
+@contextmanager
+def _outbound(service, endpoint):
+    breaker = circuit_breaker.breakers.get(service)
+    if breaker is not None and not breaker.allow():
+        record_failure(service, endpoint)
+        raise circuit_breaker.CircuitOpenError(f"{service} is unavailable, not calling it for now")
+    call = _Call()
+    start = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        call.failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        outbound_seconds.observe(elapsed, service, endpoint)
+        if call.failed:
+            record_failure(service, endpoint)
+        # A call cut short by the request's own budget says nothing about the service
+        if breaker is not None:
+            if call.failed and deadline.expired():
+                breaker.abandon()
+            else:
+                breaker.record(not call.failed and elapsed < breaker.slow_seconds)
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.append("# HELP circuit_open Whether calls to a service are paused by its circuit breaker")
+    lines.append("# TYPE circuit_open gauge")
+    lines.extend(f'circuit_open{{service="{name}"}} {int(breaker.is_open())}' for name, breaker in sorted(circuit_breaker.breakers.items()))
+    lines.append("# HELP circuit_rejected_total Calls not made because the circuit breaker was open")
+    lines.append("# TYPE circuit_rejected_total counter")
+    lines.extend(f'circuit_rejected_total{{service="{name}"}} {breaker.rejected}' for name, breaker in sorted(circuit_breaker.breakers.items()))
+    lines.append("# HELP cache_hits_total Lookups answered by a cache")
+    lines.append("# TYPE cache_hits_total counter")
+    lines.extend(f'cache_hits_total{{cache="{name}"}} {cache.hits}' for name, cache in sorted(_caches.items()))
+    lines.append("# HELP cache_misses_total Lookups a cache could not answer")
+    lines.append("# TYPE cache_misses_total counter")
+    lines.extend(f'cache_misses_total{{cache="{name}"}} {cache.misses}' for name, cache in sorted(_caches.items()))
+    return "\n".join(lines) + "\n"
+
+#Human readable totals, for the end of a batch run
+def summary():
+    lines = ["Cascade stages:"]
+    outcomes = stage_total.values()
+    for (name,), (count, total) in sorted(stage_seconds.totals().items()):
+        hits = outcomes.get((name, "hit"), 0)
+        lines.append(f"  {name:24s} {count:7d} lookups {hits:7d} found  avg {total / count * 1000:8.1f} ms")
+    matches = match_total.values()
+    if matches:
+        lines.append("get_concept_id matches: " + ", ".join(f"{method} {count}" for (method,), count in sorted(matches.items())))
+    for (), (count, total) in chunk_seconds.totals().items():
+        lines.append(f"Chunks: {count}, avg {total / count:.2f} s")
+    lines.append("Outbound calls:")
+    errors = outbound_errors.values()
+    for (service, endpoint), (count, total) in sorted(outbound_seconds.totals().items()):
+        lines.append(f"  {service + ' ' + endpoint:24s} {count:7d} calls {errors.get((service, endpoint), 0):7d} failed  "
+                     f"avg {total / count * 1000:8.1f} ms")
+    lines.append("Caches:")
+    for name, cache in sorted(_caches.items()):
+        total = cache.hits + cache.misses
+        rate = f"{cache.hits / total:.1%}" if total else "n/a"
+        lines.append(f"  {name:24s} {cache.hits:7d} hits {cache.misses:7d} misses  hit rate {rate}")
+    return "\n".join(lines)
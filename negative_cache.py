@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# Terms the whole find_code cascade could not map, so the same junk ("NA", "?", "as above",
+# ward codes) is answered at once instead of costing every Snowstorm search and Llama3
+# prompt again. An entry only counts for the terminology release it was recorded against
+# and for the cascade that recorded it: the batch script also looks names up in the
+# dictionary, so a miss of the API says nothing about the batch script.
+# The table lives in the mapping database, so MappingStore drops the entries a newly
+# learned name could resolve in the same transaction, whichever process learns it
+NEGATIVE_CACHE_PATH = os.environ.get("MAPPING_DB_PATH", "name_concept_mapping.db")
+NEGATIVE_CACHE_TTL = int(os.environ.get("NEGATIVE_CACHE_TTL", str(24 * 60 * 60)))
+MAX_ENTRIES = 100000
+# How many inserts happen between eviction sweeps
+EVICT_EVERY = 500
+
+def normalize_term(term):
+    return ' '.join(term.lower().split())
+
+def create_tables(conn):
+    # Entries recorded before the cascade was part of the key cannot be attributed to one
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(negative_cache)")]
+    if columns and 'cascade' not in columns:
+        conn.execute("DROP TABLE negative_cache")
+        conn.execute("DROP TABLE IF EXISTS negative_cache_tokens")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS negative_cache ("
+        "cascade TEXT NOT NULL, term TEXT NOT NULL, compact TEXT NOT NULL, release TEXT NOT NULL, "
+        "created REAL NOT NULL, PRIMARY KEY (cascade, term))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS negative_cache_term ON negative_cache(term)")
+    conn.execute("CREATE INDEX IF NOT EXISTS negative_cache_compact ON negative_cache(compact)")
+    # Words of each cached term, to find the terms a learned one-word name could resolve
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS negative_cache_tokens ("
+        "token TEXT NOT NULL, term TEXT NOT NULL, PRIMARY KEY (token, term)) WITHOUT ROWID"
+    )
+
+#Deletes the cached terms that the dictionary stages of find_code would now resolve with
+#the given learned names: the name itself, the name with its spaces removed, a word of
+#the name (word lookup) or a term containing the name as a word (partial lookup).
+#Runs inside the caller's transaction
+def invalidate(conn, names):
+    if conn.execute("SELECT 1 FROM negative_cache LIMIT 1").fetchone() is None:
+        return 0
+    terms = set()
+    for name in {normalize_term(name) for name in names}:
+        words = name.split()
+        placeholders = ','.join('?' * len(words))
+        terms.update(term for (term,) in conn.execute(
+            f"SELECT term FROM negative_cache WHERE term = ? OR compact = ? OR term IN ({placeholders})",
+            [name, name] + words))
+        terms.update(term for (term,) in conn.execute(
+            "SELECT term FROM negative_cache_tokens WHERE token = ?", (name,)))
+    if terms:
+        rows = [(term,) for term in terms]
+        conn.executemany("DELETE FROM negative_cache WHERE term = ?", rows)
+        conn.executemany("DELETE FROM negative_cache_tokens WHERE term = ?", rows)
+    return len(terms)
+
+class NegativeCache:
+    def __init__(self, path=NEGATIVE_CACHE_PATH, ttl=NEGATIVE_CACHE_TTL, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                create_tables(conn)
+            self._local.conn = conn
+        return conn
+
+    #True when the term is known to map to nothing in this release with the given cascade
+    def get(self, term, release, cascade):
+        row = self._connection().execute(
+            "SELECT release, created FROM negative_cache WHERE cascade = ? AND term = ?",
+            (cascade, normalize_term(term))).fetchone()
+        found = row is not None and row[0] == release and row[1] >= time.time() - self.ttl
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def put(self, term, release, cascade):
+        term = normalize_term(term)
+        if not term:
+            return
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO negative_cache (cascade, term, compact, release, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (cascade, term, term.replace(' ', ''), release, time.time()),
+            )
+            conn.executemany("INSERT OR IGNORE INTO negative_cache_tokens (token, term) VALUES (?, ?)",
+                             [(word, term) for word in set(term.split())])
+        with self._lock:
+            self._inserts += 1
+            sweep = self._inserts % EVICT_EVERY == 0
+        if sweep:
+            self.evict(release)
+
+    #Drops expired entries, entries of other releases and the oldest ones above max_entries
+    def evict(self, release):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM negative_cache WHERE created < ? OR release != ?",
+                         (time.time() - self.ttl, release))
+            conn.execute(
+                "DELETE FROM negative_cache WHERE rowid IN ("
+                "SELECT rowid FROM negative_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.execute("DELETE FROM negative_cache_tokens WHERE term NOT IN (SELECT term FROM negative_cache)")
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM negative_cache")
+            conn.execute("DELETE FROM negative_cache_tokens")
+
+cache = NegativeCache()
+metrics.register_cache("negative", cache)
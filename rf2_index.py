@@ -0,0 +1,181 @@
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+SNOMED_INDEX_PATH = os.environ.get("SNOMED_INDEX_PATH", "snomed_description_index.idx")
+
+FSN_TYPE_ID = "900000000000003001"
+MAGIC = b"SCTIDX1\n"
+HEADER = struct.Struct("<8sI")
+OFFSET = struct.Struct("<I")
+
+IndexEntry = namedtuple("IndexEntry", ["concept_id", "active", "semantic_tag", "is_fsn"])
+
+#Lower-cases and collapses whitespace. A parenthetical in a name ("Anaemia (mild)") is
+#part of what was written and is kept
+def normalize_term(term):
+    return ' '.join(term.lower().split())
+
+#Drops the trailing semantic tag of an FSN, e.g. "Asthma (disorder)" -> "Asthma"
+def strip_semantic_tag(fsn):
+    return re.sub(r'\s*\([^()]*\)\s*$', '', fsn)
+
+def _read_rf2(path):
+    with open(path, encoding='utf-8') as file:
+        next(file)
+        for line in file:
+            yield line.rstrip('\r\n').split('\t')
+
+#Reads the RF2 Snapshot concept and description files and returns sorted
+#(normalized term, concept id, active, semantic tag, is_fsn) rows
+def build_rows(concept_file, description_file):
+    concept_active = {}
+    for fields in _read_rf2(concept_file):
+        concept_active[fields[0]] = fields[2] == '1'
+
+    descriptions = []
+    semantic_tags = {}
+    for fields in _read_rf2(description_file):
+        if fields[2] != '1':
+            continue
+        concept_id, type_id, term = fields[4], fields[6], fields[7]
+        is_fsn = type_id == FSN_TYPE_ID
+        if is_fsn:
+            match = re.search(r'\(([^()]*)\)\s*$', term)
+            if match:
+                semantic_tags[concept_id] = match.group(1)
+            term = strip_semantic_tag(term)
+        descriptions.append((normalize_term(term), concept_id, is_fsn))
+
+    rows = set()
+    for term, concept_id, is_fsn in descriptions:
+        if term:
+            rows.add((term, concept_id, concept_active.get(concept_id, False),
+                      semantic_tags.get(concept_id, ''), is_fsn))
+    return sorted(rows, key=lambda row: (row[0].encode('utf-8'), not row[4], row[1]))
+
+#Writes the rows as a sorted record block plus an offset table that can be memory-mapped
+def write_index(rows, path):
+    records = []
+    for term, concept_id, active, semantic_tag, is_fsn in rows:
+        records.append(f"{term}\t{concept_id}\t{int(active)}\t{semantic_tag}\t{int(is_fsn)}\n".encode('utf-8'))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(records)))
+        position = HEADER.size + OFFSET.size * (len(records) + 1)
+        for record in records:
+            file.write(OFFSET.pack(position))
+            position += len(record)
+        file.write(OFFSET.pack(position))
+        for record in records:
+            file.write(record)
+    os.replace(tmp_path, path)
+
+# Read-only term -> concept index over a memory-mapped file built by write_index
+class DescriptionIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a SNOMED description index")
+
+    def _record(self, i):
+        start = OFFSET.unpack_from(self._map, HEADER.size + OFFSET.size * i)[0]
+        end = OFFSET.unpack_from(self._map, HEADER.size + OFFSET.size * (i + 1))[0]
+        return self._map[start:end - 1].split(b'\t')
+
+    def _lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._record(mid)[0] < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    #Returns every entry whose normalized term equals the normalized input, FSNs first
+    def lookup(self, term):
+        key = normalize_term(term).encode('utf-8')
+        entries = []
+        i = self._lower_bound(key)
+        while i < self.count:
+            fields = self._record(i)
+            if fields[0] != key:
+                break
+            entries.append(IndexEntry(fields[1].decode(), fields[2] == b'1', fields[3].decode(), fields[4] == b'1'))
+            i += 1
+        return entries
+
+    #Returns the active finding/disorder concept for an exact FSN or synonym match, or None
+    def find_concept(self, term, semantic_tags=("disorder", "finding")):
+        for entry in self.lookup(term):
+            if entry.active and entry.semantic_tag in semantic_tags:
+                return entry.concept_id
+        return None
+
+    #Yields every indexed term in sorted order
+    def iter_terms(self):
+        previous = None
+        for i in range(self.count):
+            term = self._record(i)[0]
+            if term != previous:
+                previous = term
+                yield term.decode('utf-8')
+
+    def close(self):
+        self._map.close()
+
+_index = None
+_index_missing = False
+_index_lock = threading.Lock()
+
+#Opens the index on first use; returns None when it has not been built
+def get_index():
+    global _index, _index_missing
+    if _index is None and not _index_missing:
+        with _index_lock:
+            if _index is None and not _index_missing:
+                if os.path.exists(SNOMED_INDEX_PATH):
+                    _index = DescriptionIndex(SNOMED_INDEX_PATH)
+                else:
+                    _index_missing = True
+                    logger.info("SNOMED description index %s not found, using Snowstorm only", SNOMED_INDEX_PATH)
+    return _index
+
+def find_concept(term):
+    index = get_index()
+    if index is None:
+        return None
+    return index.find_concept(term)
+
+#Builds the index from an extracted RF2 release, e.g.
+#python rf2_index.py SnomedCT_InternationalRF2_PRODUCTION_20240801T120000Z
+def main(argv):
+    if len(argv) < 2:
+        print("Usage: python rf2_index.py <RF2 release folder> [output file]")
+        return 1
+    release = argv[1]
+    output = argv[2] if len(argv) > 2 else SNOMED_INDEX_PATH
+    concept_files = glob.glob(os.path.join(release, "**", "sct2_Concept_Snapshot_*.txt"), recursive=True)
+    description_files = glob.glob(os.path.join(release, "**", "sct2_Description_Snapshot-en*_*.txt"), recursive=True)
+    if not concept_files or not description_files:
+        print(f"No RF2 Snapshot concept/description files found under {release}")
+        return 1
+    rows = build_rows(concept_files[0], description_files[0])
+    write_index(rows, output)
+    print(f"Wrote {len(rows)} terms to {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,20 @@
+import threading
+
+import wordsegment
+
+# wordsegment reads its unigram and bigram tables (close to a second) in load(), so that
+# is done on the first segmentation instead of when the scripts are imported
+_loaded = False
+_load_lock = threading.Lock()
+
+def load():
+    global _loaded
+    if not _loaded:
+        with _load_lock:
+            if not _loaded:
+                wordsegment.load()
+                _loaded = True
+
+def segment(text):
+    load()
+    return wordsegment.segment(text)
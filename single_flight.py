@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import deadline
+import metrics
+
+# Coalesces concurrent resolutions of the same diagnosis term in the API. Callers asking
+# for a term that is already being resolved wait for that resolution and share its result,
+# so a burst of identical requests runs the cascade (and its Llama3 prompts) once.
+# Across uvicorn workers a lease row in a shared SQLite file lets one worker compute while
+# the others poll for the result it publishes there
+SINGLE_FLIGHT_SHARED = os.environ.get("SINGLE_FLIGHT_SHARED", "1") != "0"
+SINGLE_FLIGHT_PATH = os.environ.get("SINGLE_FLIGHT_PATH", "single_flight.db")
+# A lease left behind by a worker that died is taken over after this many seconds
+LEASE_SECONDS = float(os.environ.get("SINGLE_FLIGHT_LEASE", "60"))
+# Published results are only meant for the callers already waiting on them
+RESULT_TTL = 10
+POLL_INTERVAL = 0.05
+
+def make_key(term):
+    return ' '.join(term.lower().split())
+
+#True for an answer cut short by its request's budget, which callers that may have the
+#time for a full one should not be given
+def is_partial(result):
+    return isinstance(result, dict) and bool(result.get("skipped_stages"))
+
+# Leases and published results shared by the workers on one machine
+class SharedFlights:
+    def __init__(self, path=SINGLE_FLIGHT_PATH, lease_seconds=LEASE_SECONDS, result_ttl=RESULT_TTL):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.owner = uuid.uuid4().hex
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS flight_leases (key TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS flight_results (key TEXT PRIMARY KEY, response TEXT, created REAL)")
+            self._local.conn = conn
+        return conn
+
+    #Returns the result another worker published for the key a moment ago, or None
+    def result(self, key):
+        row = self._connection().execute(
+            "SELECT response FROM flight_results WHERE key = ? AND created >= ?",
+            (key, time.time() - self.result_ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    #True when this worker now holds the lease on the key
+    def acquire(self, key):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM flight_leases WHERE key = ? AND expires < ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO flight_leases (key, owner, expires) VALUES (?, ?, ?)",
+                                  (key, self.owner, now + self.lease_seconds))
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM flight_leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+    #Stores the result for the workers waiting on the key and gives up the lease
+    def publish(self, key, result):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM flight_results WHERE created < ?", (now - self.result_ttl,))
+            conn.execute("INSERT OR REPLACE INTO flight_results (key, response, created) VALUES (?, ?, ?)",
+                         (key, json.dumps(result), now))
+            conn.execute("DELETE FROM flight_leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM flight_leases")
+            conn.execute("DELETE FROM flight_results")
+
+class SingleFlight:
+    def __init__(self, shared=None, poll_interval=POLL_INTERVAL):
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self._flights = {}
+
+    #Awaits function(*args) once per key at a time. The work runs in its own task, so a
+    #caller that disconnects does not cancel it for the others. The task runs under the
+    #budget of the caller that started it; the others only wait for it within their own
+    #budget and otherwise, or when its answer was cut short, call function themselves
+    async def run(self, key, function, *args):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lead(key, function, *args))
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+            return await asyncio.shield(task)
+        metrics.coalesced_total.inc("local")
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+        except asyncio.TimeoutError:
+            # With the budget spent the function only runs what needs no time and lists
+            # the stages it skipped
+            return await function(*args)
+        if is_partial(result):
+            return await function(*args)
+        return result
+
+    def _finished(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Mark the error as seen when every caller went away before it was raised
+        if not task.cancelled():
+            task.exception()
+
+    #The SQLite calls of the shared store block, so they run in a thread
+    async def _lead(self, key, function, *args):
+        shared = self.shared
+        if shared is None:
+            return await function(*args)
+        while True:
+            result = await asyncio.to_thread(shared.result, key)
+            if result is not None:
+                metrics.coalesced_total.inc("shared")
+                return result
+            if await asyncio.to_thread(shared.acquire, key):
+                break
+            if deadline.expired():
+                # No time left to wait for the other worker; answered here without the lease
+                # and not published
+                return await function(*args)
+            # Another worker is resolving the term
+            await asyncio.sleep(self.poll_interval)
+        try:
+            result = await function(*args)
+        except BaseException:
+            await asyncio.to_thread(shared.release, key)
+            raise
+        if is_partial(result):
+            await asyncio.to_thread(shared.release, key)
+        else:
+            await asyncio.to_thread(shared.publish, key, result)
+        return result
+
+flights = SingleFlight(SharedFlights() if SINGLE_FLIGHT_SHARED else None)
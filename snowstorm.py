@@ -0,0 +1,216 @@
+import logging
+import os
+import requests
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import deadline
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SNOWSTORM_URL = os.environ.get("SNOWSTORM_URL", "http://localhost:8080")
+BRANCH = "MAIN"
+
+# Upper bound on requests in flight to Snowstorm across all worker threads
+SNOWSTORM_CONCURRENCY = int(os.environ.get("SNOWSTORM_CONCURRENCY", "8"))
+snowstorm_slots = threading.BoundedSemaphore(SNOWSTORM_CONCURRENCY)
+# Seconds allowed for connecting and for an answer; a request budget can shorten the latter
+CONNECT_TIMEOUT = 2
+REQUEST_TIMEOUT = 10
+
+def request_timeout():
+    return (CONNECT_TIMEOUT, deadline.timeout(REQUEST_TIMEOUT))
+
+# Compact view of a browser concept: everything the mapping helpers need from
+# /browser/MAIN/concepts/{code} without keeping the full JSON around
+ConceptRecord = namedtuple("ConceptRecord", ["concept_id", "active", "fsn", "semantic_tag", "synonyms"])
+
+#Extracts the semantic tag, e.g. "disorder" from "Asthma (disorder)"
+def get_semantic_tag(fsn):
+    match = re.search(r'\(([^()]*)\)\s*$', fsn or '')
+    if match:
+        return match.group(1)
+    return None
+
+#Builds a ConceptRecord from a browser concept response
+def parse_concept_record(data):
+    fsn = data.get('fsn', {}).get('term')
+    synonyms = tuple(desc.get('term', '') for desc in data.get('descriptions', []) if desc.get('active', False))
+    return ConceptRecord(
+        concept_id=str(data.get('conceptId')),
+        active=bool(data.get('active', False)),
+        fsn=fsn,
+        semantic_tag=get_semantic_tag(fsn),
+        synonyms=synonyms,
+    )
+
+# In-process LRU cache with a time to live and a size bound
+class ConceptCache:
+    def __init__(self, maxsize=5000, ttl=6 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code):
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None:
+                expires, record = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(code)
+                    self.hits += 1
+                    return record
+                del self._entries[code]
+            self.misses += 1
+            return None
+
+    def put(self, code, record):
+        with self._lock:
+            self._entries[code] = (time.monotonic() + self.ttl, record)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+concept_cache = ConceptCache()
+metrics.register_cache("concept", concept_cache)
+
+#Fetches a concept from snowstorm once and serves later lookups from the cache
+def get_concept_record(code):
+    code = str(code)
+    record = concept_cache.get(code)
+    if record is not None:
+        return record
+    url = f"{SNOWSTORM_URL}/browser/{BRANCH}/concepts/{code}"
+    try:
+        with metrics.outbound("snowstorm", "concept", snowstorm_slots) as call:
+            response = requests.get(url, timeout=request_timeout())
+            call.check(response.status_code)
+        if response.status_code == 200:
+            record = parse_concept_record(response.json())
+            concept_cache.put(code, record)
+            return record
+    except Exception as e:
+        logger.warning("Error fetching concept %s from Snowstorm server: %s", code, e)
+    return None
+
+#Loads many concepts at once through the browser bulk-load endpoint.
+#Returns a dict of concept id -> ConceptRecord, serving cached concepts without a request
+def load_concept_records(codes, chunk_size=100):
+    records = {}
+    missing = []
+    for code in dict.fromkeys(str(code) for code in codes):
+        record = concept_cache.get(code)
+        if record is not None:
+            records[code] = record
+        else:
+            missing.append(code)
+    url = f"{SNOWSTORM_URL}/browser/{BRANCH}/concepts/bulk-load"
+    for start in range(0, len(missing), chunk_size):
+        batch = missing[start:start + chunk_size]
+        try:
+            with metrics.outbound("snowstorm", "bulk_load", snowstorm_slots) as call:
+                response = requests.post(url, json={"conceptIds": batch}, timeout=request_timeout())
+                call.check(response.status_code)
+            if response.status_code == 200:
+                for data in response.json():
+                    record = parse_concept_record(data)
+                    concept_cache.put(record.concept_id, record)
+                    records[record.concept_id] = record
+                continue
+            logger.warning("Bulk load returned status %s, loading concepts one by one", response.status_code)
+        except Exception as e:
+            logger.warning("Error bulk loading concepts from Snowstorm server: %s", e)
+        # Fall back to single concept requests for this batch
+        for code in batch:
+            record = get_concept_record(code)
+            if record is not None:
+                records[code] = record
+    return records
+
+# How long the release version read from Snowstorm is trusted before asking again
+RELEASE_CHECK_INTERVAL = 10 * 60
+# and how soon to ask again after it could not be read
+RELEASE_RETRY_INTERVAL = 30
+_release = (float('-inf'), None)
+_release_lock = threading.Lock()
+
+#Returns the release version cached by remember_release while it is fresh, else None
+def cached_release():
+    checked, version = _release
+    interval = RELEASE_CHECK_INTERVAL if version is not None else RELEASE_RETRY_INTERVAL
+    if time.monotonic() - checked < interval:
+        return True, version
+    return False, None
+
+def remember_release(version):
+    global _release
+    with _release_lock:
+        _release = (time.monotonic(), version)
+    return version
+
+#Reads the version of the latest SNOMED CT release imported into Snowstorm from a
+#/codesystems/SNOMEDCT response, e.g. "20240801"
+def parse_release(data):
+    latest = data.get('latestVersion') or {}
+    version = latest.get('effectiveDate') or latest.get('version')
+    return str(version) if version else None
+
+#Version of the SNOMED CT release loaded in Snowstorm, or None when it cannot be read.
+#Results tied to a release (the negative cache) are dropped when it changes
+def release_version():
+    fresh, version = cached_release()
+    if fresh:
+        return version
+    try:
+        with metrics.outbound("snowstorm", "codesystem", snowstorm_slots) as call:
+            response = requests.get(f"{SNOWSTORM_URL}/codesystems/SNOMEDCT", timeout=request_timeout())
+            call.check(response.status_code)
+        if response.status_code == 200:
+            version = parse_release(response.json())
+        else:
+            logger.warning("Snowstorm returned status %s for the code system", response.status_code)
+    except Exception as e:
+        logger.warning("Error reading the SNOMED CT release from Snowstorm server: %s", e)
+    return remember_release(version)
+
+# Term searches are restricted on the server to the clinical finding hierarchy
+# (which holds both findings and disorders) and to active concepts
+SEARCH_ECL = "<< 404684003 |Clinical finding|"
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGES = 3
+
+#Searches snowstorm for a term and yields the matching items one page at a time
+def search_concepts(term, ecl=SEARCH_ECL, page_size=SEARCH_PAGE_SIZE, max_pages=SEARCH_MAX_PAGES):
+    url = f"{SNOWSTORM_URL}/{BRANCH}/concepts"
+    params = {"term": term, "activeFilter": "true", "limit": page_size}
+    if ecl:
+        params["ecl"] = ecl
+    for _ in range(max_pages):
+        with metrics.outbound("snowstorm", "search", snowstorm_slots) as call:
+            response = requests.get(url, params=params, timeout=request_timeout())
+            call.check(response.status_code)
+        if response.status_code != 200:
+            logger.warning("Snowstorm search for '%s' returned status %s", term, response.status_code)
+            return
+        data = response.json()
+        items = data.get('items', [])
+        if items:
+            yield items
+        # Snowstorm hands back a searchAfter token while more results remain
+        search_after = data.get('searchAfter')
+        if not items or not search_after or len(items) < page_size:
+            return
+        params["searchAfter"] = search_after
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import httpx
+
+import deadline
+import metrics
+
+from snowstorm import (BRANCH, SEARCH_ECL, SEARCH_MAX_PAGES, SEARCH_PAGE_SIZE, SNOWSTORM_URL,
+                       cached_release, concept_cache, parse_concept_record, parse_release, remember_release)
+
+# Async counterpart of snowstorm.py for the API. All requests go through one pooled
+# keep-alive client, and the concept records land in the same cache as the sync helpers
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on requests in flight to Snowstorm from one API worker
+SNOWSTORM_ASYNC_CONCURRENCY = int(os.environ.get("SNOWSTORM_ASYNC_CONCURRENCY", "32"))
+CONNECT_TIMEOUT = 2
+REQUEST_TIMEOUT = 10
+
+_client = None
+_slots = None
+
+def get_client():
+    global _client, _slots
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=SNOWSTORM_URL,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=SNOWSTORM_ASYNC_CONCURRENCY,
+                                max_keepalive_connections=SNOWSTORM_ASYNC_CONCURRENCY),
+        )
+        _slots = asyncio.Semaphore(SNOWSTORM_ASYNC_CONCURRENCY)
+    return _client
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+#Names the endpoint of a path for the metrics
+def endpoint_name(path):
+    if path.endswith("/bulk-load"):
+        return "bulk_load"
+    if "/browser/" in path:
+        return "concept"
+    if path.endswith("/members"):
+        return "members"
+    if path.startswith("/codesystems"):
+        return "codesystem"
+    return "search"
+
+#Sends one request; the wait for a slot and the timeout are capped to what is left of
+#the request budget
+async def request(method, path, timeout=None, **kwargs):
+    client = get_client()
+    endpoint = endpoint_name(path)
+    try:
+        await asyncio.wait_for(_slots.acquire(), deadline.remaining())
+    except asyncio.TimeoutError:
+        raise metrics.slot_timeout("snowstorm", endpoint) from None
+    try:
+        if deadline.remaining() is not None:
+            timeout = httpx.Timeout(deadline.timeout(timeout or REQUEST_TIMEOUT), connect=deadline.timeout(CONNECT_TIMEOUT))
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        with metrics.outbound("snowstorm", endpoint) as call:
+            response = await client.request(method, path, **kwargs)
+            call.check(response.status_code)
+            return response
+    finally:
+        _slots.release()
+
+#Returns the JSON body of a GET, or None when Snowstorm does not answer with 200
+async def get_json(path, params=None, timeout=None):
+    try:
+        response = await request("GET", path, params=params, timeout=timeout)
+        if response.status_code == 200:
+            return response.json()
+        logger.warning("Snowstorm returned status %s for %s", response.status_code, path)
+    except Exception as e:
+        logger.warning("Error fetching %s from Snowstorm server: %s", path, e)
+    return None
+
+async def get_concept_record(code):
+    code = str(code)
+    record = concept_cache.get(code)
+    if record is not None:
+        return record
+    data = await get_json(f"/browser/{BRANCH}/concepts/{code}")
+    if data is None:
+        return None
+    record = parse_concept_record(data)
+    concept_cache.put(code, record)
+    return record
+
+async def load_concept_records(codes, chunk_size=100):
+    records = {}
+    missing = []
+    for code in dict.fromkeys(str(code) for code in codes):
+        record = concept_cache.get(code)
+        if record is not None:
+            records[code] = record
+        else:
+            missing.append(code)
+
+    async def load_batch(batch):
+        try:
+            response = await request("POST", f"/browser/{BRANCH}/concepts/bulk-load", json={"conceptIds": batch})
+            if response.status_code == 200:
+                return [parse_concept_record(data) for data in response.json()]
+            logger.warning("Bulk load returned status %s, loading concepts one by one", response.status_code)
+        except Exception as e:
+            logger.warning("Error bulk loading concepts from Snowstorm server: %s", e)
+        loaded = await asyncio.gather(*(get_concept_record(code) for code in batch))
+        return [record for record in loaded if record is not None]
+
+    batches = [missing[start:start + chunk_size] for start in range(0, len(missing), chunk_size)]
+    for loaded in await asyncio.gather(*(load_batch(batch) for batch in batches)):
+        for record in loaded:
+            concept_cache.put(record.concept_id, record)
+            records[record.concept_id] = record
+    return records
+
+#Async snowstorm.release_version, sharing its cached value
+async def release_version():
+    fresh, version = cached_release()
+    if fresh:
+        return version
+    data = await get_json("/codesystems/SNOMEDCT")
+    return remember_release(parse_release(data) if data is not None else None)
+
+#Yields the matching items one page at a time, like snowstorm.search_concepts
+async def search_concepts(term, ecl=SEARCH_ECL, page_size=SEARCH_PAGE_SIZE, max_pages=SEARCH_MAX_PAGES):
+    params = {"term": term, "activeFilter": "true", "limit": page_size}
+    if ecl:
+        params["ecl"] = ecl
+    for _ in range(max_pages):
+        response = await request("GET", f"/{BRANCH}/concepts", params=params)
+        if response.status_code != 200:
+            logger.warning("Snowstorm search for '%s' returned status %s", term, response.status_code)
+            return
+        data = response.json()
+        items = data.get('items', [])
+        if items:
+            yield items
+        search_after = data.get('searchAfter')
+        if not items or not search_after or len(items) < page_size:
+            return
+        params["searchAfter"] = search_after
@@ -0,0 +1,155 @@
+import logging
+import os
+import re
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+import rf2_index
+from mapping_store import MappingStore
+
+logger = logging.getLogger(__name__)
+
+# Spelling correction against the clinical vocabulary (SNOMED description words plus the
+# learned names) instead of general English. Candidates are found with a symmetric-delete
+# index: a dictionary word and a misspelling within the edit distance share a deletion
+MAX_EDIT_DISTANCE = int(os.environ.get("SPELLING_MAX_EDIT_DISTANCE", "2"))
+# Only the first letters of a word are indexed, which keeps the delete table small
+PREFIX_LENGTH = 7
+# Shorter words are mostly abbreviations (htn, dm, copd) and are left alone
+MIN_WORD_LENGTH = 4
+CACHE_SIZE = 50000
+# Word counts of the description index written by "python spelling.py", read instead of
+# walking the whole index at start-up
+SPELLING_VOCABULARY_PATH = os.environ.get("SPELLING_VOCABULARY_PATH", "spelling_vocabulary.txt")
+
+WORD_RE = re.compile(r'[a-z]+')
+
+def _deletes(word, distance):
+    deletes = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))} - deletes
+        deletes |= frontier
+    return deletes
+
+#Optimal string alignment distance (edits plus adjacent swaps), or max_distance + 1 once it is exceeded
+def edit_distance(a, b, max_distance):
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+class SpellingCorrector:
+    def __init__(self, word_counts, max_distance=MAX_EDIT_DISTANCE, cache_size=CACHE_SIZE):
+        self.max_distance = max_distance
+        self.counts = word_counts
+        self.deletes = {}
+        for word in word_counts:
+            if len(word) >= MIN_WORD_LENGTH:
+                for delete in _deletes(word[:PREFIX_LENGTH], max_distance):
+                    self.deletes.setdefault(delete, []).append(word)
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    #Returns the closest vocabulary word (most frequent on ties), or the word itself
+    def correct_word(self, word):
+        if len(word) < MIN_WORD_LENGTH or word in self.counts or not word.isalpha():
+            return word
+        with self._lock:
+            cached = self._cache.get(word)
+            if cached is not None:
+                self._cache.move_to_end(word)
+                return cached
+        best, best_key = word, None
+        seen = set()
+        for delete in _deletes(word[:PREFIX_LENGTH], self.max_distance):
+            for candidate in self.deletes.get(delete, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = edit_distance(word, candidate, self.max_distance)
+                if distance <= self.max_distance:
+                    key = (distance, -self.counts[candidate])
+                    if best_key is None or key < best_key:
+                        best, best_key = candidate, key
+        with self._lock:
+            self._cache[word] = best
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return best
+
+    def correct(self, text):
+        return ' '.join(self.correct_word(word) for word in text.lower().split())
+
+def snomed_vocabulary():
+    counts = Counter()
+    index = rf2_index.get_index()
+    if index is not None:
+        for term in index.iter_terms():
+            counts.update(WORD_RE.findall(term))
+    return counts
+
+def read_vocabulary(path):
+    counts = Counter()
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            word, count = line.rstrip('\n').split('\t')
+            counts[word] = int(count)
+    return counts
+
+def write_vocabulary(counts, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        for word, count in sorted(counts.items()):
+            file.write(f"{word}\t{count}\n")
+    os.replace(tmp_path, path)
+
+def vocabulary():
+    if os.path.exists(SPELLING_VOCABULARY_PATH):
+        counts = read_vocabulary(SPELLING_VOCABULARY_PATH)
+    else:
+        counts = snomed_vocabulary()
+    for name, _ in MappingStore().items():
+        counts.update(WORD_RE.findall(name.lower()))
+    return counts
+
+_corrector = None
+_corrector_lock = threading.Lock()
+
+#Builds the corrector from the description index and the mapping on first use
+def get_corrector():
+    global _corrector
+    if _corrector is None:
+        with _corrector_lock:
+            if _corrector is None:
+                _corrector = SpellingCorrector(vocabulary())
+                logger.info("Spelling corrector loaded %s words", len(_corrector.counts))
+    return _corrector
+
+def correct(text):
+    return get_corrector().correct(text)
+
+#Writes the word counts of the description index, e.g. after rf2_index.py built a new one
+def main(argv):
+    output = argv[1] if len(argv) > 1 else SPELLING_VOCABULARY_PATH
+    if rf2_index.get_index() is None:
+        return 1
+    counts = snomed_vocabulary()
+    write_vocabulary(counts, output)
+    print(f"Wrote {len(counts)} words to {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
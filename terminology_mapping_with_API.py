@@ -1,20 +1,48 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 
 app = FastAPI()
 
-import requests
+import asyncio
 import re
-import wordsegment
-import subprocess
-from spellchecker import SpellChecker
+import os
+import json
+import time
+import logging
+import segmenter
+import llm_cache
+import rf2_index
+import vector_index
+import spelling
+import fuzzy_rank
+import icd10_map
+import metrics
+import deadline
+import negative_cache
+import single_flight
+from mapping_store import MappingStore
+import llm_client
+from llm_client import CLOSEST_FSN_PROMPT, EXPAND_PROMPT
+import snowstorm_async
+from snowstorm_async import get_concept_record, load_concept_records, search_concepts
 
-wordsegment.load()
-name_concept_mapping = dict()
+metrics.configure_logging()
+logger = logging.getLogger(__name__)
+name_concept_mapping = MappingStore()
+
+# Number of distinct terms of one batch request resolved at the same time
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "8"))
+# Set API_WARM_UP=0 (e.g. with uvicorn --reload) to load everything on first use instead
+API_WARM_UP = os.environ.get("API_WARM_UP", "1") != "0"
+# Seconds a request may take when it does not set its own budget (budget_ms or the
+# X-Request-Budget-Ms header). Stages that no longer fit are skipped and listed in the
+# response under skipped_stages
+API_REQUEST_BUDGET = float(os.environ.get("API_REQUEST_BUDGET", "30"))
 
 def segment_compound_word(compound_word):
-    segmented_words = wordsegment.segment(compound_word)
+    segmented_words = segmenter.segment(compound_word)
     if len(segmented_words) > 1:
         if 's' in segmented_words:
             segmented_words.remove('s')
@@ -24,173 +52,167 @@ def segment_compound_word(compound_word):
     
 #Corrects spelling of the words
 def correct_text(text):
-    spell = SpellChecker()
-    words = text.split()
-    corrected_text = []
-    for word in words:
-        corrected_word = spell.correction(word)
-        corrected_text.append(corrected_word)
-    if None in corrected_text:
-        return None
-    return ' '.join(corrected_text)
+    # The corrector is built once from the clinical vocabulary and caches each word
+    return spelling.correct(text)
+
+# The helpers below segment, spell-check or touch the SQLite stores and so block; the
+# async code runs them through asyncio.to_thread to keep the event loop free
+
+#Returns the spell-corrected name, or None when nothing was corrected, and the concept
+#the local lookups find for it, if any
+def lookup_spelled(name):
+    spelled_name = correct_text(name)
+    if spelled_name == ' '.join(name.lower().split()):
+        return None, None
+    return spelled_name, name_concept_mapping.get(spelled_name) or rf2_index.find_concept(spelled_name)
+
+#Saves a resolved name and the synonyms of its concept in one transaction
+def learn_name(name, concept_id, synonyms):
+    mapping = {synonym.lower(): concept_id for synonym in synonyms}
+    mapping[name.lower()] = concept_id
+    name_concept_mapping.update(mapping)
 
-def retrieve_ICD10_code_and_advice(code):
-    url = f"http://localhost:8080/MAIN/members?referenceSet=447562003&referencedComponentId={code}"
+#Scores the parts of the names that the dictionary and the description index do not know
+def prefetch_vectors(names):
+    vector_index.prefetch([part for name in names for part in split_names(name)
+                           if name_concept_mapping.get(part) is None and rf2_index.find_concept(part) is None])
+
+async def retrieve_ICD10_code_and_advice(code):
+    # The preloaded map answers without a request; its first entry is map group 1, priority 1
+    entries = icd10_map.get_map_entries(code)
+    if entries is not None:
+        if entries:
+            return entries[0].map_target, entries[0].map_advice
+        return None, None
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
+        data = await snowstorm_async.get_json("/MAIN/members", params={"referenceSet": "447562003", "referencedComponentId": code})
+        if data is not None:
             target_component_id = str(code)
             items = data.get('items', [])
             for item in items:
                 if item.get('referencedComponentId') == target_component_id:
-                    print("yes")
                     additional_fields = item.get('additionalFields', {})
                     map_target = additional_fields.get('mapTarget')
                     map_advice = additional_fields.get('mapAdvice') 
                     return(map_target,map_advice)
     except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
+        logger.warning("Error fetching the ICD-10 map from Snowstorm server: %s", e)
     return None,None
 
 # This function checks if the concept is active or not
-def is_concept_active(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('active', False):
-                return True
-            else:
-                return False
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return []
+async def is_concept_active(code):
+    record = await get_concept_record(code)
+    if record is None:
+        return []
+    return record.active
 
 #This function gets all the active synonyms for a particular concept
-def get_display_name_from_snowstorm(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            # Initialize an empty list to store the terms
-            descriptions = []
-            # Iterate over each dictionary in the 'descriptions' list
-            for desc in data.get('descriptions', []):
-                # Check if the 'active' field is True
-                if desc.get('active', False):
-                    # Get the value of the 'term' key, defaulting to an empty string if not present
-                    term = desc.get('term', '')
-                    # Append the term to the 'descriptions' list
-                    descriptions.append(term)
-            return descriptions
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return []
+async def get_display_name_from_snowstorm(code):
+    record = await get_concept_record(code)
+    if record is None:
+        return []
+    return list(record.synonyms)
 
 #this function checks whether the concept is a finding or disorder type
-def check_fsn_type(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            concept = data["fsn"]["term"]
-            if "(disorder)" in concept or "(finding)" in concept:
-                return True
-            return False
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return []
-
-def get_fsn_name(code):
-    url = f"http://localhost:8080/browser/MAIN/concepts/{code}"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            concept = data["fsn"]["term"]
-            return concept
-    except Exception as e:
-        print(f"Error fetching display name from Snowstorm server: {e}")
-    return None
+async def check_fsn_type(code):
+    record = await get_concept_record(code)
+    if record is None:
+        return []
+    return record.semantic_tag in ("disorder", "finding")
 
-def run_ollama_medllama2(query):
-    try:
-        command = ['ollama', 'run', 'llama3', '--', query]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, encoding='utf-8')
-        if result.returncode != 0:
-            print("Error running the command:", result.stderr)
-            return None
-        return result.stdout.strip()
-    except Exception as e:
-        print("An error occurred:", e)
+async def get_fsn_name(code):
+    record = await get_concept_record(code)
+    if record is None:
         return None
+    return record.fsn
+
+#Prompts wait for Ollama on the event loop and are sent from the LLM batcher's own
+#threads, so requests waiting on the model do not use up the asyncio.to_thread pool
+async def run_ollama_medllama2(template, **inputs):
+    return await llm_cache.cached_generate_async(template, **inputs)
 
 #This function gets me the code we search for the term on snowstorm
-def get_concept_id(name):
-    url = f"http://localhost:8080/MAIN/concepts?term={name}"
+async def get_concept_id(name):
+    matched_concepts = []
+    synonym_concept_mapping = {}
+    all_candidates = []
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            matched_concepts = []
-            synonym_concept_mapping = {}
-
-            if data['total'] != 0:
-                # First pass: Check FSNs and collect potential matches
-                for item in data['items']:
-                    if 'fsn' in item and 'term' in item['fsn']:
-                        fsn_term = re.sub(r'\(.*?\)', '', item['fsn']['term'].lower())
-                        if check_fsn_type(item['conceptId']) and item['active']:
-                            matched_concepts.append((fsn_term, item['conceptId']))
-                            if name.lower() == fsn_term:
-                                return item['conceptId']
-    
-                # Second pass: Check synonyms if FSN did not match exactly
-                for item in data['items']:
-                    if check_fsn_type(item['conceptId']) and item['active']:
-                        synonyms = get_display_name_from_snowstorm(item['conceptId'])
-                        for synonym in synonyms:
-                            synonym_term = synonym.lower()
-                            synonym_concept_mapping[synonym_term] = item['conceptId']
-                            if name.lower() == synonym_term:
-                                return item['conceptId']
-    
-                # Third pass: Check if the name is a subset of any synonyms
-                for synonym_term, concept_id in synonym_concept_mapping.items():
-                    if name.lower() in synonym_term:
-                        return concept_id
+        # Snowstorm filters to active findings/disorders and pages through the results
+        async for items in search_concepts(name):
+            # Hydrate the page in one bulk request and keep the findings/disorders
+            records = await load_concept_records([item['conceptId'] for item in items])
+            candidates = []
+            for item in items:
+                record = records.get(item['conceptId'])
+                if item['active'] and record is not None and record.fsn and record.semantic_tag in ("disorder", "finding"):
+                    candidates.append(record)
+            all_candidates.extend(candidates)
 
-                # Send only FSN names to Llama for semantic comparison if no synonym matches
-                fsn_list = [fsn for fsn, _ in matched_concepts]
-                query = f"Which of these FSN terms is the closest in meaning to '{name}': {', '.join(fsn_list)}? Provide the answer in the format (in ['']) ['closest term'] or ['None']."
-                print(query)
-                result = run_ollama_medllama2(query)
-                print(result)
-                    
-               # Parse the result to find the closest FSN or None
-                print(matched_concepts)
-                match = re.search(r"\['(.*?)'\]", result)
-                if match:
-                    closest_term = match.group(1).strip().lower()
-                    print(closest_term)
-                    if closest_term != "none":
-                        # Find the concept ID corresponding to the closest FSN term
-                        for fsn_term, concept_id in matched_concepts:
-                            if closest_term == fsn_term.strip():
-                                return concept_id
-                    
-                # If Llama returns 'None' or no match is found, return None
-                print("none")
-                return None
-        else:
-            print(f"Concept ID not found for diagnostic name '{name}'")
+            # First pass: Check FSNs and collect potential matches
+            for record in candidates:
+                fsn_term = re.sub(r'\(.*?\)', '', record.fsn.lower())
+                matched_concepts.append((fsn_term, record.concept_id))
+                if name.lower() == fsn_term:
+                    metrics.match_total.inc("exact_fsn")
+                    return record.concept_id
+
+            # Second pass: Check synonyms if FSN did not match exactly
+            for record in candidates:
+                for synonym in record.synonyms:
+                    synonym_term = synonym.lower()
+                    synonym_concept_mapping[synonym_term] = record.concept_id
+                    if name.lower() == synonym_term:
+                        metrics.match_total.inc("synonym")
+                        return record.concept_id
+
+        if not matched_concepts:
+            logger.debug("Concept ID not found for diagnostic name '%s'", name)
+            metrics.match_total.inc("none")
             return None
+
+        # Third pass: Check if the name is a subset of any synonyms
+        for synonym_term, concept_id in synonym_concept_mapping.items():
+            if name.lower() in synonym_term:
+                metrics.match_total.inc("substring")
+                return concept_id
+
+        # Rank the candidates locally and only ask Llama when the best match is not clear-cut
+        ranked, confident = await asyncio.to_thread(
+            fuzzy_rank.best_match, name, [(record.concept_id, (record.fsn,) + record.synonyms) for record in all_candidates])
+        if ranked is not None:
+            logger.debug("Fuzzy match for '%s': '%s' (%s) score %.3f by %s, confident: %s",
+                         name, ranked.term, ranked.concept_id, ranked.score, ranked.method, confident)
+            if confident:
+                metrics.match_total.inc("fuzzy")
+                return ranked.concept_id
+
+        # Send only FSN names to Llama for semantic comparison if no synonym matches
+        if not deadline.allows("llm_closest", deadline.LLM_STAGE_SECONDS, "ollama"):
+            metrics.match_total.inc("none")
+            return None
+        fsn_list = [fsn for fsn, _ in matched_concepts]
+        logger.debug("Asking Llama3 for the FSN closest to '%s' among %s", name, fsn_list)
+        with metrics.stage("llm_closest") as stage:
+            result = await run_ollama_medllama2(CLOSEST_FSN_PROMPT, name=name, fsn_list=', '.join(fsn_list))
+            stage.hit = result is not None
+        logger.debug("Llama3 answered %r", result)
+
+        # Parse the result to find the closest FSN or None
+        match = re.search(r"\['(.*?)'\]", result)
+        if match:
+            closest_term = match.group(1).strip().lower()
+            if closest_term != "none":
+                # Find the concept ID corresponding to the closest FSN term
+                for fsn_term, concept_id in matched_concepts:
+                    if closest_term == fsn_term.strip():
+                        metrics.match_total.inc("llm_closest")
+                        return concept_id
+
+        # If Llama returns 'None' or no match is found, return None
+        metrics.match_total.inc("none")
+        return None
     except Exception as e:
-        print(f"Error fetching concept ID from Snowstorm server: {e}")
+        logger.warning("Error fetching concept ID from Snowstorm server: %s", e)
         return None
 
 #check if a name is present in the synonyms
@@ -217,109 +239,118 @@ def extract_terms_from_medllama_output(output):
                 terms.append(term)
         return terms
 
-def find_code(corrected_name):
-    concept_id = get_concept_id(corrected_name)
+#Splits a diagnosis name on "and", "with" and "," into the names find_code looks up
+def split_names(name):
+    return [part.strip() for part in re.split(r'(?:\s*(?:\band\b|\b,\b|\bwith\b)\s*)+', name, flags=re.IGNORECASE)]
+
+#Runs the cascade, answering the names it could not map for the current SNOMED release
+#from the negative cache
+async def find_code(corrected_name):
+    release = await snowstorm_async.release_version()
+    with metrics.stage("negative_cache") as stage:
+        stage.hit = release is not None and await asyncio.to_thread(negative_cache.cache.get, corrected_name, release, "api")
+    if stage.hit:
+        return (None, "")
+    with metrics.track_failures() as failures, deadline.tracking() as current:
+        result = await find_code_uncached(corrected_name)
+    # An outage of Snowstorm or Ollama is not an answer, so those misses are not remembered,
+    # and neither are the ones where a stage was skipped
+    if result[0] is None and release is not None and not failures and not current.skipped:
+        await asyncio.to_thread(negative_cache.cache.put, corrected_name, release, "api")
+    return result
+
+async def find_code_uncached(corrected_name):
+    # Exact FSN/synonym matches come from the local RF2 index without a Snowstorm round-trip
+    concept_id = metrics.run_stage("description_index", rf2_index.find_concept, corrected_name)
+    spelled_name = None
     if concept_id is None:
+        # Fix typos against the clinical vocabulary and retry the local lookups
+        with metrics.stage("spelling") as stage:
+            spelled_name, concept_id = await asyncio.to_thread(lookup_spelled, corrected_name)
+            stage.hit = concept_id is not None
+    # The remote stages only start while the request budget leaves room for them and the
+    # service's circuit breaker is closed
+    if concept_id is None and deadline.allows("snowstorm_search", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
+        concept_id = await metrics.run_stage_async("snowstorm_search", get_concept_id, corrected_name)
+    if concept_id is None and spelled_name is not None and deadline.allows("spelled_search", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
+        # The corrected spelling may find what the name as typed did not
+        concept_id = await metrics.run_stage_async("spelled_search", get_concept_id, spelled_name)
+    if concept_id is None and deadline.allows("concatenated", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
         word = re.sub(r'\s+', '', corrected_name)
         if word != corrected_name:
-            concept_id = get_concept_id(word.lower())
-    if concept_id is None:
-        word = segment_compound_word(corrected_name.lower())
-        concept_id = get_concept_id(word.lower())
+            concept_id = await metrics.run_stage_async("concatenated", get_concept_id, word.lower())
+    if concept_id is None and deadline.allows("segmented", deadline.SNOWSTORM_STAGE_SECONDS, "snowstorm"):
+        with metrics.stage("segmented") as stage:
+            word = await asyncio.to_thread(segment_compound_word, corrected_name.lower())
+            concept_id = await get_concept_id(word.lower())
+            stage.hit = concept_id is not None
+    if concept_id is None and deadline.allows("nearest_description", deadline.NEAREST_STAGE_SECONDS):
+        # Nearest SNOMED description by character n-grams, for misspellings the search misses
+        concept_id = await metrics.run_stage_async("nearest_description", asyncio.to_thread, vector_index.find_nearest, corrected_name)
     if concept_id:
-        synonyms = get_display_name_from_snowstorm(concept_id)
-        name_concept_mapping[corrected_name.lower()] = concept_id
-        for synonym in synonyms:
-            name_concept_mapping[synonym.lower()] = concept_id
+        synonyms = await get_display_name_from_snowstorm(concept_id)
+        await asyncio.to_thread(learn_name, corrected_name, concept_id, synonyms)
         return (concept_id, "Diagnosis found from SNOMED")
-    else:
-        query = (
-            f"Only provide me the primary disease or condition terms/expand medical abbreviations without any conjunctions or descriptive qualifiers. "
-            f"If no corrections are needed, return the input as a single term. "
-            f"Provide the corrected term in the format ['corrected_term']. "
-            f"Diagnosis: '{corrected_name}'"
-        )
-        print(query)
-        medllama_output = run_ollama_medllama2(query)
-        print(medllama_output)
-        if medllama_output:
-            corrected_terms = extract_terms_from_medllama_output(medllama_output)
-            print(corrected_terms)
-            if corrected_terms:
-                snowstorm_results = []
-                for term in corrected_terms:
-                    snomed_result = get_concept_id(term)
-                    if snomed_result:
-                        snowstorm_results.append(snomed_result)
+    elif deadline.allows("llm_expand", deadline.LLM_STAGE_SECONDS, "ollama"):
+        with metrics.stage("llm_expand") as stage:
+            medllama_output = await run_ollama_medllama2(EXPAND_PROMPT, diagnosis=corrected_name)
+            filtered_results = []
+            if medllama_output:
+                corrected_terms = extract_terms_from_medllama_output(medllama_output)
+                logger.debug("Llama3 expanded '%s' to %s", corrected_name, corrected_terms)
+                snowstorm_results = await asyncio.gather(*(get_concept_id(term) for term in corrected_terms))
                 filtered_results = [res for res in snowstorm_results if res is not None]
-                if filtered_results:
-                    for result in filtered_results:
-                        synonyms = get_display_name_from_snowstorm(result)
-                        name_concept_mapping[corrected_name.lower()] = result
-                        for synonym in synonyms:
-                            name_concept_mapping[synonym.lower()] = result
-                    return ', '.join(filtered_results), "Used Llama3 to get the term"
+            stage.hit = bool(filtered_results)
+        if filtered_results:
+            for result in filtered_results:
+                synonyms = await get_display_name_from_snowstorm(result)
+                await asyncio.to_thread(learn_name, corrected_name, result, synonyms)
+            return ', '.join(filtered_results), "Used Llama3 to get the term"
 
     return (None, "")
 
-def process_concept_id(name, concept_id, correction_status):
-    results = []
-    if "," in concept_id:  # Check if concept_id contains multiple IDs
-        individual_ids = concept_id.split(", ")
-        for individual_id in individual_ids:
-            concept_name = get_fsn_name(individual_id)
-            url = f"https://browser.ihtsdotools.org/?perspective=full&conceptId1={individual_id}&edition=MAIN/2024-08-01&release=&languages=en"
-            icd10_code, advice = retrieve_ICD10_code_and_advice(individual_id)
-            results.append({
-                "term": name,
-                "system ": "SNOMED CT",
-                "code ": individual_id,
-                "text": concept_name,
-                "Retrival Method": correction_status,
-                "url": url,
-                "ICD10_code": icd10_code,
-                "Mapping_advice": advice
-            })
-    else:
-        concept_name = get_fsn_name(concept_id)
-        url = f"https://browser.ihtsdotools.org/?perspective=full&conceptId1={concept_id}&edition=MAIN/2024-08-01&release=&languages=en"
-        icd10_code, advice = retrieve_ICD10_code_and_advice(concept_id)
-        results.append({
-            "term": name,
-            "system ": "SNOMED CT",
-            "code ": concept_id,
-            "text": concept_name,
-            "Retrival Method": correction_status,
-            "url": url,
-            "ICD10_code": icd10_code,
-            "Mapping_advice": advice
-        })
-    return results
+#Builds the result entry for one concept
+async def concept_result(name, concept_id, correction_status):
+    concept_name, (icd10_code, advice) = await asyncio.gather(
+        get_fsn_name(concept_id), retrieve_ICD10_code_and_advice(concept_id))
+    url = f"https://browser.ihtsdotools.org/?perspective=full&conceptId1={concept_id}&edition=MAIN/2024-08-01&release=&languages=en"
+    return {
+        "term": name,
+        "system ": "SNOMED CT",
+        "code ": concept_id,
+        "text": concept_name,
+        "Retrival Method": correction_status,
+        "url": url,
+        "ICD10_code": icd10_code,
+        "Mapping_advice": advice
+    }
 
-def snomed_code_not_present(name: str) -> dict[str, list[dict[str, str]]]:
+async def process_concept_id(name, concept_id, correction_status):
+    # concept_id can hold several IDs separated by ", "
+    individual_ids = concept_id.split(", ")
+    return list(await asyncio.gather(*(concept_result(name, individual_id, correction_status) for individual_id in individual_ids)))
+
+async def snomed_code_not_present(name: str) -> dict[str, list[dict[str, str]]]:
     results = []
     split_words = name.lower().split()
 
     if "and" in split_words or "with" in split_words or "," in split_words:
-        concept_id = get_concept_id(name)
+        concept_id = await get_concept_id(name)
         if concept_id:
-            name_concept_mapping[name.lower()] = concept_id
-            concept_name = get_fsn_name(concept_id)
-            synonyms = get_display_name_from_snowstorm(concept_id)
-            for synonym in synonyms:
-                name_concept_mapping[synonym.lower()] = concept_id
+            synonyms = await get_display_name_from_snowstorm(concept_id)
+            await asyncio.to_thread(learn_name, name, concept_id, synonyms)
             correction_status = "Diagnosis found from SNOMED"
-            results.extend(process_concept_id(name, concept_id, correction_status))
+            results.extend(await process_concept_id(name, concept_id, correction_status))
 
-    corrected_names = [name.strip() for name in re.split(r'(?:\s*(?:\band\b|\b,\b|\bwith\b)\s*)+', name, flags=re.IGNORECASE)]
+    corrected_names = split_names(name)
 
     for corrected_name in corrected_names:
-        concept_id, correction_status = find_code(corrected_name)
+        concept_id, correction_status = await find_code(corrected_name)
         if concept_id and correction_status:
-            results.extend(process_concept_id(corrected_name, concept_id, correction_status))
+            results.extend(await process_concept_id(corrected_name, concept_id, correction_status))
         else:
             correction_status = 'Concept ID not found'
-            print(f"Concept ID not found for diagnostic name '{corrected_name}'.")
+            logger.debug("Concept ID not found for diagnostic name '%s'.", corrected_name)
             results.append({
                 "term": corrected_name,
                 "system ": "SNOMED CT",
@@ -331,16 +362,136 @@ def snomed_code_not_present(name: str) -> dict[str, list[dict[str, str]]]:
                 "Mapping_advice": "N/A"
             })
 
-    return {"results": results}
+    response = {"results": results}
+    skipped = deadline.skipped()
+    if skipped:
+        response["skipped_stages"] = skipped
+    return response
 
 
 class DiagnosisRequest(BaseModel):
     diagnosis_type: str
     diagnostic_term: str
+    budget_ms: Optional[int] = None
+
+
+#Returns the time.monotonic() value a request must be answered by
+def request_deadline(budget_ms, header_budget_ms):
+    budget_ms = budget_ms if budget_ms is not None else header_budget_ms
+    seconds = budget_ms / 1000 if budget_ms is not None else API_REQUEST_BUDGET
+    return time.monotonic() + max(seconds, 0)
 
 
 @app.post("/get_snomed_code")
-def get_snomed_code(request: DiagnosisRequest):
+async def get_snomed_code(request: DiagnosisRequest,
+                          x_request_budget_ms: Optional[int] = Header(None)):
     diagnostic_term = request.diagnostic_term.strip()
-    response = snomed_code_not_present(diagnostic_term)
+    response = await resolve_term(diagnostic_term, request_deadline(request.budget_ms, x_request_budget_ms))
     return response
+
+
+#Maps a term within the budget, sharing the work with the requests (in this or another
+#worker) that are resolving the same term at the same time
+async def resolve_term(term, expires):
+    with deadline.until(expires):
+        return await single_flight.flights.run(single_flight.make_key(term), snomed_code_not_present, term)
+
+
+class DiagnosisBatchRequest(BaseModel):
+    diagnosis_type: str
+    diagnostic_terms: list[str]
+    budget_ms: Optional[int] = None
+
+
+#Resolves a list of terms concurrently and streams one JSON line per input term as soon
+#as its result is ready. Terms that only differ in case or spacing are resolved once
+@app.post("/get_snomed_codes")
+async def get_snomed_codes(request: DiagnosisBatchRequest,
+                           x_request_budget_ms: Optional[int] = Header(None)):
+    # One budget covers the whole list
+    expires = request_deadline(request.budget_ms, x_request_budget_ms)
+    terms = [term.strip() for term in request.diagnostic_terms]
+    positions = {}
+    for index, term in enumerate(terms):
+        positions.setdefault(' '.join(term.lower().split()), []).append(index)
+
+    # Score the parts the dictionary and the description index do not know in one go
+    await asyncio.to_thread(prefetch_vectors, list(positions))
+
+    slots = asyncio.Semaphore(BATCH_WORKERS)
+
+    async def resolve(indices):
+        async with slots:
+            try:
+                response = await resolve_term(terms[indices[0]], expires)
+            except Exception as e:
+                logger.exception("Error mapping '%s'", terms[indices[0]])
+                response = {"error": str(e)}
+        return indices, response
+
+    async def stream():
+        for task in asyncio.as_completed([resolve(indices) for indices in positions.values()]):
+            indices, response = await task
+            for index in indices:
+                yield json.dumps({"index": index, "term": terms[index], **response}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+#Lists the SNOMED concepts mapped to an ICD-10 code or code prefix, e.g. R32 or E11.*
+@app.get("/get_snomed_codes_for_icd10")
+async def get_snomed_codes_for_icd10(code: str, offset: int = 0, limit: int = 50):
+    offset = max(offset, 0)
+    limit = min(max(limit, 1), 500)
+    found = icd10_map.find_concepts(code, offset=offset, limit=limit)
+    if found is None:
+        raise HTTPException(status_code=503, detail="The ICD-10 map has not been built, see icd10_map.py")
+    total, matches = found
+    fsns = {concept_id: icd10_map.get_fsn(concept_id) for concept_id, _ in matches}
+    # Only maps saved without FSNs need Snowstorm for them
+    missing = [concept_id for concept_id, fsn in fsns.items() if fsn is None]
+    if missing:
+        records = await load_concept_records(missing)
+        fsns.update({concept_id: record.fsn for concept_id, record in records.items()})
+    results = []
+    for concept_id, entry in matches:
+        results.append({
+            "ICD10_code": entry.map_target,
+            "system": "SNOMED CT",
+            "code": concept_id,
+            "text": fsns.get(concept_id),
+            "Mapping_advice": entry.map_advice,
+            "map_group": entry.map_group,
+            "map_priority": entry.map_priority,
+            "map_rule": entry.map_rule,
+            "url": f"https://browser.ihtsdotools.org/?perspective=full&conceptId1={concept_id}&edition=MAIN/2024-08-01&release=&languages=en",
+        })
+    return {"query": code, "total": total, "offset": offset, "limit": limit, "results": results}
+
+
+#Loads the segmenter, the local indexes, the ICD-10 map and the Llama3 model up front,
+#so the first requests do not pay for them
+def warm_up():
+    segmenter.load()
+    rf2_index.get_index()
+    spelling.get_corrector()
+    vector_index.get_index()
+    icd10_map.get_table()
+    llm_client.client.warm_up()
+
+
+@app.on_event("startup")
+async def warm_up_on_startup():
+    if API_WARM_UP:
+        await asyncio.to_thread(warm_up)
+
+
+#Counters and latency histograms in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await snowstorm_async.close()
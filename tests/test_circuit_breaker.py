@@ -0,0 +1,101 @@
+import unittest
+
+import circuit_breaker
+import deadline
+import metrics
+from circuit_breaker import CircuitBreaker
+
+# Moves the breaker's pause into the past instead of sleeping through it
+def end_pause(breaker):
+    breaker.opened_at -= breaker.reset_seconds
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("test", slow_seconds=5, failures=3, reset_seconds=30)
+
+    def open(self):
+        for _ in range(self.breaker.max_failures):
+            self.breaker.record(False)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.breaker.record(True)
+        self.breaker.record(False)
+        self.assertFalse(self.breaker.is_open())
+        self.open()
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.rejected, 1)
+
+    def test_one_probe_after_the_pause(self):
+        self.open()
+        end_pause(self.breaker)
+        self.assertTrue(self.breaker.allow())
+        # Only the probe goes out until its outcome is known
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.open()
+        end_pause(self.breaker)
+        self.breaker.allow()
+        self.breaker.record(True)
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_restarts_the_pause(self):
+        self.open()
+        end_pause(self.breaker)
+        self.breaker.allow()
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    def test_abandoned_probe_lets_the_next_call_probe(self):
+        self.open()
+        end_pause(self.breaker)
+        self.breaker.allow()
+        self.breaker.abandon()
+        self.assertTrue(self.breaker.allow())
+
+class OutboundTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("test", slow_seconds=5, failures=1, reset_seconds=30)
+        circuit_breaker.breakers["test"] = self.breaker
+
+    def tearDown(self):
+        del circuit_breaker.breakers["test"]
+
+    def call(self, error=None):
+        with metrics.outbound("test", "call"):
+            if error is not None:
+                raise error
+
+    def test_open_breaker_rejects_the_call(self):
+        self.breaker.record(False)
+        with self.assertRaises(circuit_breaker.CircuitOpenError):
+            self.call()
+
+    def test_probe_cut_short_by_the_budget_is_abandoned(self):
+        self.breaker.record(False)
+        end_pause(self.breaker)
+        opened_at = self.breaker.opened_at
+        with deadline.budget(0), self.assertRaises(TimeoutError):
+            self.call(TimeoutError())
+        self.assertFalse(self.breaker.probing)
+        self.assertEqual(self.breaker.opened_at, opened_at)
+        # The next call is the probe and closes the breaker
+        self.call()
+        self.assertFalse(self.breaker.is_open())
+
+    def test_failed_probe_within_the_budget_counts(self):
+        self.breaker.record(False)
+        end_pause(self.breaker)
+        with deadline.budget(10), self.assertRaises(ConnectionError):
+            self.call(ConnectionError())
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+if __name__ == "__main__":
+    unittest.main()
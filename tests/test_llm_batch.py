@@ -0,0 +1,107 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest import mock
+
+import llm_batch
+import llm_client
+from llm_batch import AsyncMicroBatcher, RoundBatcher, _Item, _send
+from llm_client import EXPAND_PROMPT
+
+# Stands in for llm_client.generate: records the prompts and answers a batch prompt with
+# the given answers, or each diagnosis with itself
+class FakeLlama:
+    def __init__(self, answers=None):
+        self.answers = answers
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt, json_format=False, **options):
+        with self._lock:
+            self.prompts.append(prompt)
+        if not json_format:
+            return "['single answer']"
+        if self.answers is not None:
+            return json.dumps({"answers": self.answers})
+        items = json.loads(prompt[prompt.index("Diagnoses: ") + len("Diagnoses: "):])
+        return json.dumps({"answers": [[item] for item in items]})
+
+def expand(diagnosis):
+    return EXPAND_PROMPT.format(diagnosis=diagnosis)
+
+class SendTest(unittest.TestCase):
+    def test_batch_answers_every_item(self):
+        llama = FakeLlama([["diabetes mellitus"], "hypertension"])
+        items = [_Item({"diagnosis": "DM"}), _Item({"diagnosis": "HTN"})]
+        with mock.patch.object(llm_client, "generate", llama):
+            _send(EXPAND_PROMPT, items)
+        self.assertEqual([item.response for item in items], ["['diabetes mellitus']", "['hypertension']"])
+        self.assertEqual(len(llama.prompts), 1)
+
+    def test_malformed_answer_is_asked_on_its_own(self):
+        llama = FakeLlama([["diabetes mellitus"], 42, []])
+        items = [_Item({"diagnosis": "DM"}), _Item({"diagnosis": "HTN"}), _Item({"diagnosis": "CKD"})]
+        with mock.patch.object(llm_client, "generate", llama):
+            _send(EXPAND_PROMPT, items)
+        self.assertEqual([item.response for item in items],
+                         ["['diabetes mellitus']", "['single answer']", "['single answer']"])
+        self.assertEqual(llama.prompts[1:], [expand("HTN"), expand("CKD")])
+
+    def test_missing_answers_are_all_asked_on_their_own(self):
+        llama = FakeLlama([["diabetes mellitus"]])
+        items = [_Item({"diagnosis": "DM"}), _Item({"diagnosis": "HTN"})]
+        with mock.patch.object(llm_client, "generate", llama):
+            _send(EXPAND_PROMPT, items)
+        self.assertEqual(llama.prompts[1:], [expand("DM"), expand("HTN")])
+
+class RoundBatcherTest(unittest.TestCase):
+    def run_chunk(self, workers):
+        batcher = RoundBatcher(batch_size=3, concurrency=2)
+        llama = FakeLlama()
+        names = ["n%d" % i for i in range(8)]
+        with mock.patch.object(llm_client, "generate", llama):
+            results = batcher.map(lambda name: batcher.generate(EXPAND_PROMPT, {"diagnosis": name}, name),
+                                  names, workers)
+        return results, llama.prompts
+
+    def test_prompts_are_grouped_in_row_order(self):
+        results, prompts = self.run_chunk(workers=4)
+        self.assertEqual(results, ["['n%d']" % i for i in range(8)])
+        groups = sorted(json.loads(prompt[prompt.index("Diagnoses: ") + len("Diagnoses: "):]) for prompt in prompts)
+        self.assertEqual(groups, [["n0", "n1", "n2"], ["n3", "n4", "n5"], ["n6", "n7"]])
+
+    def test_grouping_does_not_depend_on_the_workers(self):
+        expected = sorted(self.run_chunk(workers=1)[1])
+        for workers in (2, 8):
+            self.assertEqual(sorted(self.run_chunk(workers)[1]), expected)
+
+    def test_error_of_a_value_is_raised(self):
+        batcher = RoundBatcher(batch_size=3, concurrency=1)
+        with self.assertRaises(ValueError):
+            batcher.map(int, ["1", "x", "3"], 2)
+
+class AsyncMicroBatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def test_partial_parse_failure_in_a_batch(self):
+        batcher = AsyncMicroBatcher(batch_size=2, wait=1, concurrency=1)
+        llama = FakeLlama([["diabetes mellitus"], None])
+        with mock.patch.object(llm_client, "generate", llama):
+            results = await asyncio.gather(batcher.generate(EXPAND_PROMPT, {"diagnosis": "DM"}),
+                                           batcher.generate(EXPAND_PROMPT, {"diagnosis": "HTN"}))
+        self.assertEqual(results, ["['diabetes mellitus']", "['single answer']"])
+        self.assertEqual(llama.prompts[1:], [expand("HTN")])
+
+    async def test_failed_calls_answer_none(self):
+        batcher = AsyncMicroBatcher(batch_size=2, wait=0.01, concurrency=1)
+        with mock.patch.object(llm_client, "generate", mock.Mock(return_value=None)):
+            self.assertIsNone(await batcher.generate(EXPAND_PROMPT, {"diagnosis": "DM"}))
+
+class GenerateTest(unittest.TestCase):
+    def test_outside_a_chunk_prompts_are_sent_alone(self):
+        llama = FakeLlama()
+        with mock.patch.object(llm_client, "generate", llama):
+            self.assertEqual(llm_batch.generate(EXPAND_PROMPT, {"diagnosis": "DM"}, "DM"), "['single answer']")
+        self.assertEqual(llama.prompts, [expand("DM")])
+
+if __name__ == "__main__":
+    unittest.main()
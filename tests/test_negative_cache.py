@@ -0,0 +1,81 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from mapping_store import MappingStore
+from negative_cache import NegativeCache
+
+class NegativeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "mapping.db")
+        self.store = MappingStore(self.path)
+        self.cache = NegativeCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_belong_to_a_release(self):
+        self.cache.put("NA", "20240801", "batch")
+        self.assertTrue(self.cache.get(" na ", "20240801", "batch"))
+        self.assertFalse(self.cache.get("na", "20250101", "batch"))
+
+    def test_entries_belong_to_a_cascade(self):
+        self.cache.put("hypertension zzqx", "20240801", "api")
+        self.assertTrue(self.cache.get("hypertension zzqx", "20240801", "api"))
+        self.assertFalse(self.cache.get("hypertension zzqx", "20240801", "batch"))
+
+    def test_entries_expire(self):
+        cache = NegativeCache(self.path, ttl=60)
+        cache.put("as above", "20240801", "batch")
+        with cache._connection() as conn:
+            conn.execute("UPDATE negative_cache SET created = ?", (time.time() - 61,))
+        self.assertFalse(cache.get("as above", "20240801", "batch"))
+
+    def assert_learning_drops(self, name, term):
+        self.cache.put(term, "20240801", "batch")
+        self.cache.put(term, "20240801", "api")
+        self.cache.put("ward 7", "20240801", "batch")
+        self.store[name] = "38341003"
+        self.assertFalse(self.cache.get(term, "20240801", "batch"))
+        self.assertFalse(self.cache.get(term, "20240801", "api"))
+        self.assertTrue(self.cache.get("ward 7", "20240801", "batch"))
+
+    def test_learning_the_term_drops_it(self):
+        self.assert_learning_drops("Hypertension ZZQX", "hypertension zzqx")
+
+    def test_learning_the_term_without_spaces_drops_it(self):
+        self.assert_learning_drops("hypertensionzzqx", "hypertension zzqx")
+
+    def test_learning_a_name_containing_the_term_drops_it(self):
+        self.assert_learning_drops("essential hypertension", "hypertension")
+
+    def test_learning_a_word_of_the_term_drops_it(self):
+        self.assert_learning_drops("hypertension", "hypertension zzqx")
+
+    def test_deferred_names_drop_entries_when_saved(self):
+        self.cache.put("hypertension zzqx", "20240801", "batch")
+        with self.store.deferred() as pending:
+            self.store["hypertension"] = "38341003"
+        self.assertTrue(self.cache.get("hypertension zzqx", "20240801", "batch"))
+        self.store.update(pending)
+        self.assertFalse(self.cache.get("hypertension zzqx", "20240801", "batch"))
+
+    def test_table_without_cascades_is_replaced(self):
+        path = os.path.join(self.directory, "old.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE negative_cache (term TEXT PRIMARY KEY, compact TEXT NOT NULL, "
+                     "release TEXT NOT NULL, created REAL NOT NULL)")
+        conn.execute("INSERT INTO negative_cache VALUES ('na', 'na', '20240801', ?)", (time.time(),))
+        conn.commit()
+        conn.close()
+        cache = NegativeCache(path)
+        self.assertFalse(cache.get("na", "20240801", "batch"))
+        cache.put("na", "20240801", "batch")
+        self.assertTrue(cache.get("na", "20240801", "batch"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+import deadline
+from single_flight import SingleFlight
+
+# Coroutine function whose calls return the given results in turn, the first one after
+# a delay, counting the calls
+class Resolver:
+    def __init__(self, first_delay, *results):
+        self.first_delay = first_delay
+        self.results = list(results)
+        self.calls = 0
+
+    async def __call__(self, term):
+        self.calls += 1
+        result = self.results[self.calls - 1]
+        if self.calls == 1:
+            await asyncio.sleep(self.first_delay)
+        return result
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+
+    async def follow(self, resolver, budget=None):
+        # Let the leader start first
+        await asyncio.sleep(0)
+        if budget is None:
+            return await self.flights.run("asthma", resolver, "asthma")
+        with deadline.budget(budget):
+            return await self.flights.run("asthma", resolver, "asthma")
+
+    async def test_followers_share_the_leader_result(self):
+        resolver = Resolver(0.05, {"code": "195967001"})
+        results = await asyncio.gather(self.flights.run("asthma", resolver, "asthma"),
+                                       self.follow(resolver), self.follow(resolver))
+        self.assertEqual(results, [{"code": "195967001"}] * 3)
+        self.assertEqual(resolver.calls, 1)
+
+    async def test_follower_out_of_budget_resolves_itself(self):
+        resolver = Resolver(0.5, {"code": "leader"}, {"code": "follower"})
+        leader = asyncio.ensure_future(self.flights.run("asthma", resolver, "asthma"))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.assertEqual(await self.follow(resolver, budget=0.05), {"code": "follower"})
+        self.assertLess(loop.time() - start, 0.4)
+        # The leader's work is not cancelled by the follower giving up on it
+        self.assertEqual(await leader, {"code": "leader"})
+
+    async def test_follower_does_not_take_a_partial_result(self):
+        partial = {"code": None, "skipped_stages": ["llm_expand"]}
+        resolver = Resolver(0.05, partial, {"code": "195967001"})
+        results = await asyncio.gather(self.flights.run("asthma", resolver, "asthma"), self.follow(resolver))
+        self.assertEqual(results, [partial, {"code": "195967001"}])
+        self.assertEqual(resolver.calls, 2)
+
+    async def test_flight_ends_with_its_leader(self):
+        resolver = Resolver(0, {"code": "first"}, {"code": "second"})
+        self.assertEqual(await self.flights.run("asthma", resolver, "asthma"), {"code": "first"})
+        self.assertEqual(await self.flights.run("asthma", resolver, "asthma"), {"code": "second"})
+
+if __name__ == "__main__":
+    unittest.main()
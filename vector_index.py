@@ -0,0 +1,218 @@
+import glob
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+
+import rf2_index
+
+logger = logging.getLogger(__name__)
+
+# numpy and scipy take a while to import and are only needed once an index is built or
+# opened, so they are imported then
+np = None
+sparse = None
+
+def _import_numpy():
+    global np, sparse
+    if sparse is None:
+        import numpy
+        import scipy.sparse
+        np, sparse = numpy, scipy.sparse
+
+SNOMED_VECTOR_INDEX_PATH = os.environ.get("SNOMED_VECTOR_INDEX_PATH", "snomed_vector_index")
+
+# Character n-grams of each word (padded with spaces) hashed into a fixed number of columns
+NGRAM_SIZE = 3
+N_FEATURES = 2 ** 20
+# A nearest description below this cosine similarity is not trusted. One wrong letter in
+# a two word name already costs about a third of the shared trigrams
+MIN_SCORE = float(os.environ.get("VECTOR_MIN_SCORE", "0.70"))
+# Queries are multiplied against the index this many at a time; common n-grams make each
+# result row touch a large share of the index, so this bounds the memory of one product
+QUERY_BLOCK_SIZE = int(os.environ.get("VECTOR_QUERY_BLOCK_SIZE", "32"))
+
+def ngrams(text):
+    grams = []
+    for word in rf2_index.normalize_term(text).split():
+        padded = f" {word} "
+        if len(padded) <= NGRAM_SIZE:
+            grams.append(padded)
+        else:
+            grams.extend(padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1))
+    return grams
+
+#Hashes every text into a sparse row of sublinear n-gram counts
+def count_matrix(texts):
+    data, indices, indptr = [], [], [0]
+    for text in texts:
+        counts = {}
+        for gram in ngrams(text):
+            column = zlib.crc32(gram.encode('utf-8')) % N_FEATURES
+            counts[column] = counts.get(column, 0) + 1
+        for column, count in sorted(counts.items()):
+            indices.append(column)
+            data.append(1.0 + math.log(count))
+        indptr.append(len(indices))
+    return sparse.csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32),
+                              np.array(indptr, dtype=np.int64)), shape=(len(texts), N_FEATURES))
+
+def l2_normalize(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags((1.0 / norms).astype(np.float32)) @ matrix
+
+#Builds the TF-IDF matrix over the active finding/disorder descriptions of an RF2 release
+def build_index(concept_file, description_file, path=SNOMED_VECTOR_INDEX_PATH):
+    _import_numpy()
+    pairs = sorted({(term, concept_id) for term, concept_id, active, semantic_tag, _ in
+                    rf2_index.build_rows(concept_file, description_file)
+                    if active and semantic_tag in ("disorder", "finding")})
+    terms = [term for term, _ in pairs]
+    counts = count_matrix(terms)
+    document_frequency = np.bincount(counts.indices, minlength=N_FEATURES)
+    idf = (np.log((1 + len(terms)) / (1 + document_frequency)) + 1).astype(np.float32)
+    matrix = l2_normalize(counts @ sparse.diags(idf)).tocsr()
+
+    # Saved n-gram major, the layout queries are multiplied against, so that it can be
+    # used straight from the memory-mapped files
+    matrix_t = matrix.T.tocsr()
+    # scipy copies index arrays into the smallest dtype that holds them
+    index_dtype = np.int32 if matrix_t.nnz < 2 ** 31 else np.int64
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "data.npy"), matrix_t.data.astype(np.float32))
+    np.save(os.path.join(path, "indices.npy"), matrix_t.indices.astype(index_dtype))
+    np.save(os.path.join(path, "indptr.npy"), matrix_t.indptr.astype(index_dtype))
+    np.save(os.path.join(path, "idf.npy"), idf)
+    np.save(os.path.join(path, "concept_ids.npy"), np.array([int(concept_id) for _, concept_id in pairs], dtype=np.int64))
+    encoded = [term.encode('utf-8') for term in terms]
+    np.save(os.path.join(path, "term_offsets.npy"), np.cumsum([0] + [len(term) for term in encoded]).astype(np.int64))
+    with open(os.path.join(path, "terms.bin"), 'wb') as file:
+        file.write(b''.join(encoded))
+    with open(os.path.join(path, "meta.json"), 'w') as file:
+        json.dump({"ngram_size": NGRAM_SIZE, "n_features": N_FEATURES, "terms": len(terms), "layout": "ngram_major"}, file)
+    return len(terms)
+
+# Nearest-description search over the saved index. The arrays are memory-mapped, so
+# opening it is cheap and several processes share the same pages
+class VectorIndex:
+    def __init__(self, path):
+        _import_numpy()
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode='r')
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+        if meta["ngram_size"] != NGRAM_SIZE or meta["n_features"] != N_FEATURES:
+            raise ValueError(f"{path} was built with different n-gram settings")
+        if meta.get("layout") != "ngram_major":
+            raise ValueError(f"{path} was built by an older version of vector_index.py, rebuild it")
+        self.matrix_t = sparse.csr_matrix((load("data.npy"), load("indices.npy"), load("indptr.npy")),
+                                          shape=(N_FEATURES, meta["terms"]))
+        self.idf = np.asarray(load("idf.npy"))
+        self.concept_ids = load("concept_ids.npy")
+        self.term_offsets = load("term_offsets.npy")
+        with open(os.path.join(path, "terms.bin"), 'rb') as file:
+            self.terms = file.read()
+
+    def term(self, i):
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].decode('utf-8')
+
+    #Returns, for every name, up to k (concept_id, term, score) tuples, best first.
+    #Each block of names is scored with one sparse matrix product
+    def nearest(self, names, k=5):
+        results = []
+        for start in range(0, len(names), QUERY_BLOCK_SIZE):
+            block = names[start:start + QUERY_BLOCK_SIZE]
+            queries = l2_normalize(count_matrix(block) @ sparse.diags(self.idf)).tocsr()
+            scores = (queries @ self.matrix_t).tocsr()
+            for row in range(len(block)):
+                row_scores = scores.data[scores.indptr[row]:scores.indptr[row + 1]]
+                row_terms = scores.indices[scores.indptr[row]:scores.indptr[row + 1]]
+                top = np.argsort(-row_scores)[:k * 4]
+                matches, seen = [], set()
+                for i in top:
+                    concept_id = str(self.concept_ids[row_terms[i]])
+                    if concept_id not in seen:
+                        seen.add(concept_id)
+                        matches.append((concept_id, self.term(row_terms[i]), float(row_scores[i])))
+                    if len(matches) == k:
+                        break
+                results.append(matches)
+        return results
+
+_index = None
+_index_missing = False
+_index_lock = threading.Lock()
+# Results of recent queries, filled in bulk by prefetch
+_nearest_cache = OrderedDict()
+NEAREST_CACHE_SIZE = 20000
+
+#Opens the index on first use; returns None when it has not been built
+def get_index():
+    global _index, _index_missing
+    if _index is None and not _index_missing:
+        with _index_lock:
+            if _index is None and not _index_missing:
+                if os.path.exists(os.path.join(SNOMED_VECTOR_INDEX_PATH, "meta.json")):
+                    _index = VectorIndex(SNOMED_VECTOR_INDEX_PATH)
+                else:
+                    _index_missing = True
+                    logger.info("SNOMED vector index %s not found, skipping nearest description search", SNOMED_VECTOR_INDEX_PATH)
+    return _index
+
+def _remember(name, matches):
+    with _index_lock:
+        _nearest_cache[name] = matches
+        _nearest_cache.move_to_end(name)
+        while len(_nearest_cache) > NEAREST_CACHE_SIZE:
+            _nearest_cache.popitem(last=False)
+
+#Scores many names in one go so that later find_nearest calls for them are lookups
+def prefetch(names):
+    index = get_index()
+    if index is None:
+        return
+    names = list(dict.fromkeys(name.lower() for name in names if name))
+    for name, matches in zip(names, index.nearest(names)):
+        _remember(name, matches)
+
+#Returns the concept of the nearest active finding/disorder description, or None
+def find_nearest(name, min_score=MIN_SCORE):
+    index = get_index()
+    if index is None or not name:
+        return None
+    key = name.lower()
+    with _index_lock:
+        matches = _nearest_cache.get(key)
+    if matches is None:
+        matches = index.nearest([key])[0]
+        _remember(key, matches)
+    if matches and matches[0][2] >= min_score:
+        concept_id, term, score = matches[0]
+        logger.debug("Nearest description for '%s': '%s' (%s) score %.3f", name, term, concept_id, score)
+        return concept_id
+    return None
+
+#python vector_index.py <RF2 release folder> [output folder]
+def main(argv):
+    if len(argv) < 2:
+        print("Usage: python vector_index.py <RF2 release folder> [output folder]")
+        return 1
+    release = argv[1]
+    output = argv[2] if len(argv) > 2 else SNOMED_VECTOR_INDEX_PATH
+    concept_files = glob.glob(os.path.join(release, "**", "sct2_Concept_Snapshot_*.txt"), recursive=True)
+    description_files = glob.glob(os.path.join(release, "**", "sct2_Description_Snapshot-en*_*.txt"), recursive=True)
+    if not concept_files or not description_files:
+        print(f"No RF2 Snapshot concept/description files found under {release}")
+        return 1
+    count = build_index(concept_files[0], description_files[0], output)
+    print(f"Indexed {count} descriptions in {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))